@@ -0,0 +1,53 @@
+import datetime
+import threading
+import time
+import types
+
+import numpy
+
+from wx_explore.common.storage.azure_tables import AzureTableBackend
+
+
+def test_put_fields_bounds_pending_builds():
+    backend = AzureTableBackend('account', 'key', 'table')
+    backend.max_pending_builds = 4
+    backend.max_queued_batches = 2
+
+    proj = types.SimpleNamespace(id=1, n_x=10, n_y=100)
+    now = datetime.datetime(2020, 1, 1)
+    fields = {(1, now, now): [numpy.zeros((proj.n_y, proj.n_x), dtype=numpy.float32)]}
+
+    lock = threading.Lock()
+    n_built = 0
+    n_committed = 0
+    commits_blocked = threading.Event()
+
+    def build_batches(proj, fields, y):
+        nonlocal n_built
+        with lock:
+            n_built += 1
+        return [[{'PartitionKey': f"{proj.id}-{y}"}]]
+
+    def commit_batch(entities):
+        nonlocal n_committed
+        commits_blocked.wait()
+        with lock:
+            n_committed += 1
+
+    backend._build_batches = build_batches
+    backend._commit_batch = commit_batch
+
+    putter = threading.Thread(target=backend.put_fields, args=(proj, fields))
+    putter.start()
+
+    try:
+        # With commits stalled, only the queued batches and pending builds can have been built
+        time.sleep(0.5)
+        with lock:
+            assert n_built <= backend.max_pending_builds + backend.max_queued_batches
+    finally:
+        commits_blocked.set()
+        putter.join()
+        backend.close()
+
+    assert n_built == n_committed == proj.n_y
@@ -0,0 +1,90 @@
+"""
+Points which are missing in a quantized S3 band (e.g. outside a model's domain) must never reach responses as NaN.
+
+Like the app itself, this needs the dev database (see README.md). Run with `python -m pytest tests` in the dev container.
+"""
+from datetime import timedelta
+
+import json
+import pytest
+
+from wx_explore.common import metrics
+from wx_explore.common.cache import bucketed_now
+from wx_explore.common.models import FileBandMeta, FileMeta
+from wx_explore.common.storage.s3 import S3Backend
+from wx_explore.web.api import controller
+from wx_explore.web.app import app
+
+LOC = (3, 2)
+
+
+def strict_json(body: bytes):
+    def reject(constant):
+        raise ValueError(f"Invalid JSON constant {constant}")
+
+    return json.loads(body, parse_constant=reject)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    start = bucketed_now()
+    backend = S3Backend('access', 'secret', bucket='test')
+
+    # One location chunk with a u1 band for each of 3 hours. The second hour is missing.
+    chunk = bytes([20, FileBandMeta.U1_MISSING, 22])
+
+    async def load_stripe_chunks(fm, y, xs):
+        return {x: chunk for x in xs}
+
+    monkeypatch.setattr(backend, 'load_stripe_chunks', load_stripe_chunks)
+
+    def load_data_points(coords, load_start, load_end, source_fields):
+        sf = next(sf for sf in source_fields if sf.metric_id == metrics.temp.id)
+        fm = FileMeta(file_name='test', loc_size=len(chunk), block_size=None)
+        fbms = [
+            FileBandMeta(
+                file_name=fm.file_name,
+                file_meta=fm,
+                offset=i,
+                vals_per_loc=1,
+                encoding='u1',
+                scale=1.0,
+                add_offset=0.0,
+                source_field_id=sf.id,
+                source_field=sf,
+                valid_time=start + timedelta(hours=i),
+                run_time=start,
+            )
+            for i in range(len(chunk))
+        ]
+        return backend._load_fields_batch(fbms, 10, [LOC])[LOC]
+
+    monkeypatch.setattr(controller, 'load_data_points', load_data_points)
+    # Always build the response
+    monkeypatch.setattr(controller.response_cache, 'get', lambda etag: None)
+    monkeypatch.setattr(controller.response_cache, 'set', lambda etag, value: None)
+
+    yield app.test_client(), start
+
+    backend.close()
+
+
+def test_wx_skips_missing_points(client):
+    client, start = client
+
+    resp = client.get('/api/wx', query_string={'lat': 40.7, 'lon': -74.0, 'metrics': metrics.temp.id})
+    assert resp.status_code == 200
+
+    data = strict_json(resp.data)
+    assert len(data['ordered_times']) == 2
+    assert str(int((start + timedelta(hours=1)).timestamp())) not in data['data']
+    assert sorted(point['value'] for points in data['data'].values() for point in points) == [20, 22]
+
+
+def test_summarize_skips_missing_points(client):
+    client, start = client
+
+    resp = client.get('/api/wx/summarize', query_string={'lat': 40.7, 'lon': -74.0, 'days': 1})
+    assert resp.status_code == 200
+
+    strict_json(resp.data)
@@ -1,10 +1,11 @@
 from typing import Iterator, List, Dict, Tuple
 import datetime
-from wx_explore.common.models import Metric, SourceField, DataPointSet
+from wx_explore.common.catalog import catalog
+from wx_explore.common.models import Metric, DataPointSet
 
 
 def get_metric(sfid: int) -> Metric:
-    return SourceField.query.get(sfid).metric
+    return catalog.get_source_field(sfid).metric
 
 
 def group_by_time(groups: List[List[DataPointSet]]) -> Iterator[Tuple[datetime.datetime, Tuple[DataPointSet, ...]]]:
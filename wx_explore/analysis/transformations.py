@@ -13,3 +13,43 @@ def cartesian_to_polar(u, v):
     theta -= 90
     theta = -theta % 360
     return r, theta
+
+
+def vapor_pressure(q, p):
+    """
+    Vapor pressure (Pa) from specific humidity q (kg/kg) and pressure p (Pa)
+    """
+    return q * p / (0.622 + 0.378 * q)
+
+
+def saturation_vapor_pressure(t):
+    """
+    Saturation vapor pressure (Pa) over water at temperature t (K), using Bolton's formula
+    """
+    return 611.2 * numpy.exp(17.67 * (t - 273.15) / (t - 29.65))
+
+
+def relative_humidity(q, t, p):
+    """
+    Relative humidity (%) from specific humidity q (kg/kg), temperature t (K) and pressure p (Pa)
+    """
+    rh = 100 * vapor_pressure(q, p) / saturation_vapor_pressure(t)
+    return (numpy.clip(rh, 0, 100),)
+
+
+def dewpoint(q, p):
+    """
+    Dewpoint (K) from specific humidity q (kg/kg) and pressure p (Pa) (inverse of Bolton's formula)
+    """
+    # Avoid log(0) for (unrealistically) dry air
+    ln_e = numpy.log(numpy.maximum(vapor_pressure(q, p), 1e-3) / 611.2)
+    return (273.15 + 243.5 * ln_e / (17.67 - ln_e),)
+
+
+def apparent_temperature(q, t, p, wind_speed):
+    """
+    Apparent temperature (K) from specific humidity q (kg/kg), temperature t (K), pressure p (Pa)
+    and wind speed (m/s), using the Australian Bureau of Meteorology's (shade) formula
+    """
+    e_hpa = vapor_pressure(q, p) / 100
+    return (t + 0.33 * e_hpa - 0.70 * wind_speed - 4.00,)
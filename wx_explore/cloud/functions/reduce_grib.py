@@ -4,7 +4,7 @@ import tempfile
 from wx_explore.cloud.proxy import HttpResponse, proxy
 from wx_explore.cloud.helpers import s3_client, db_engine
 from wx_explore.common.models import Source, SourceField
-from wx_explore.ingest.reduce_grib import reduce_grib
+from wx_explore.ingest.grib import reduce_grib
 
 
 def func(req):
@@ -9,7 +9,7 @@ import tempfile
 
 from wx_explore.cloud.proxy import HttpRequest, HttpResponse, proxy
 from wx_explore.common.models import SourceField
-from wx_explore.ingest.reduce_grib import reduce_grib
+from wx_explore.ingest.grib import reduce_grib
 
 
 def func(req: HttpRequest) -> HttpResponse:
@@ -0,0 +1,165 @@
+from sqlalchemy.exc import IntegrityError
+from typing import Any, Hashable, Optional
+
+import collections
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+from wx_explore.common.config import Config
+from wx_explore.common.models import DataVersion
+from wx_explore.web.core import db
+
+logger = logging.getLogger(__name__)
+
+DATA_VERSION_ID = 1
+
+
+def bump_data_version():
+    """
+    Marks all cached responses as stale. Should be called after any new data is committed.
+    """
+    for _ in range(2):
+        n_updated = DataVersion.query.filter_by(id=DATA_VERSION_ID).update({
+            DataVersion.version: DataVersion.version + 1,
+            DataVersion.updated: datetime.datetime.utcnow(),
+        })
+
+        if n_updated == 0:
+            db.session.add(DataVersion(id=DATA_VERSION_ID, version=1))
+
+        try:
+            db.session.commit()
+            return
+        except IntegrityError:
+            # Someone else created the row first, so update it instead
+            db.session.rollback()
+
+
+_data_version: Optional[int] = None
+_data_version_checked_at: Optional[float] = None
+
+
+def get_data_version() -> int:
+    """
+    Returns the current data version.
+    This is only re-read from the DB every DATA_VERSION_TTL seconds so it can be
+    checked on every request without a round trip.
+    """
+    global _data_version, _data_version_checked_at
+
+    if _data_version_checked_at is None or time.monotonic() - _data_version_checked_at >= Config.DATA_VERSION_TTL:
+        _data_version = db.session.query(DataVersion.version).filter_by(id=DATA_VERSION_ID).scalar() or 0
+        _data_version_checked_at = time.monotonic()
+
+    return _data_version
+
+
+def bucketed_now(bucket_seconds: Optional[int] = None) -> datetime.datetime:
+    """
+    Returns the current (UTC) time, rounded down to bucket_seconds.
+    Using this instead of the exact time for default time ranges means requests
+    made close together ask for the same range, so they can share a cache entry.
+    """
+    if bucket_seconds is None:
+        bucket_seconds = Config.RESPONSE_CACHE_TIME_BUCKET
+
+    now = int(time.time())
+    return datetime.datetime.fromtimestamp(now - (now % bucket_seconds), tz=datetime.timezone.utc)
+
+
+class LRUCache(object):
+    """
+    Simple thread-safe in-process LRU cache
+    """
+    max_size: int
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+class RedisCache(object):
+    """
+    Cache shared between processes (and hosts) backed by redis.
+    """
+    ttl: int
+
+    def __init__(self, url: str, ttl: int):
+        # Only needed if a shared cache is configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(f"wx_response:{key}")
+
+    def set(self, key: str, value: bytes):
+        self.client.set(f"wx_response:{key}", value, ex=self.ttl)
+
+
+class ResponseCache(object):
+    """
+    Two tier (in-process LRU, then optionally shared) cache of serialized responses.
+    Keys should include everything the response depends on; the current data version
+    is added automatically so entries are invalidated whenever new data is saved.
+    """
+    local: LRUCache
+    shared: Optional[RedisCache]
+
+    def __init__(self, max_size: int, shared_url: Optional[str] = None, shared_ttl: int = 3600):
+        self.local = LRUCache(max_size)
+        self.shared = RedisCache(shared_url, shared_ttl) if shared_url else None
+
+    def etag(self, key: Hashable) -> str:
+        return hashlib.sha1(repr((get_data_version(), key)).encode('utf-8')).hexdigest()
+
+    def get(self, etag: str) -> Optional[bytes]:
+        value = self.local.get(etag)
+        if value is not None or self.shared is None:
+            return value
+
+        try:
+            value = self.shared.get(etag)
+        except Exception:
+            logger.exception("Unable to read from shared response cache")
+            return None
+
+        if value is not None:
+            self.local.set(etag, value)
+
+        return value
+
+    def set(self, etag: str, value: bytes):
+        self.local.set(etag, value)
+
+        if self.shared is not None:
+            try:
+                self.shared.set(etag, value)
+            except Exception:
+                logger.exception("Unable to write to shared response cache")
+
+
+response_cache = ResponseCache(
+    Config.RESPONSE_CACHE_SIZE,
+    Config.RESPONSE_CACHE_REDIS_URL,
+    Config.RESPONSE_CACHE_TTL,
+)
@@ -0,0 +1,142 @@
+from sqlalchemy.orm import Session, joinedload
+from typing import Dict, Iterable, List, Optional
+
+import logging
+import threading
+import time
+
+from wx_explore.common.cache import get_data_version
+from wx_explore.common.config import Config
+from wx_explore.common.models import (
+    Source,
+    SourceField,
+    Metric,
+    Projection,
+)
+from wx_explore.web.core import db
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCatalog(object):
+    """
+    In-process cache of the (small, rarely changing) metadata tables: sources,
+    source fields, metrics, and projections.
+
+    Everything is loaded at once in its own session and then detached, so lookups
+    never hit the DB. The catalog is reloaded when the data version is bumped (e.g.
+    ingest created a projection), after `ttl` seconds, or on the next lookup after
+    `invalidate` is called. Looking up an unknown projection or source field also
+    reloads it (at most once every `miss_refresh_interval` seconds).
+    """
+    ttl: float
+    version: int
+    miss_refresh_interval: float = 5
+
+    sources: Dict[int, Source]
+    source_fields: Dict[int, SourceField]
+    metrics: Dict[int, Metric]
+    projections: Dict[int, Projection]
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0
+        self._loaded_at: Optional[float] = None
+        # Data version when the catalog was last loaded
+        self._data_version: Optional[int] = None
+        self._lock = threading.Lock()
+
+        self.sources = {}
+        self.source_fields = {}
+        self.metrics = {}
+        self.projections = {}
+
+    def refresh(self):
+        logger.info("Loading metadata catalog")
+
+        # Read before loading so a bump while loading triggers another reload
+        data_version = get_data_version()
+
+        # expire_on_commit=False so objects stay usable after the session is closed
+        session = Session(db.engine, expire_on_commit=False)
+        try:
+            sources = {s.id: s for s in session.query(Source).all()}
+            metrics = {m.id: m for m in session.query(Metric).all()}
+            projections = {p.id: p for p in session.query(Projection).all()}
+            source_fields = {
+                sf.id: sf
+                for sf in session.query(SourceField).options(joinedload(SourceField.projection)).all()
+            }
+        finally:
+            session.close()
+
+        self.sources = sources
+        self.metrics = metrics
+        self.projections = projections
+        self.source_fields = source_fields
+        self.version += 1
+        self._data_version = data_version
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _is_stale(self) -> bool:
+        return (
+            self._loaded_at is None
+            or time.monotonic() - self._loaded_at >= self.ttl
+            or get_data_version() != self._data_version
+        )
+
+    def _ensure_loaded(self):
+        if not self._is_stale():
+            return
+
+        with self._lock:
+            # Someone else may have refreshed while we were waiting on the lock
+            if self._is_stale():
+                self.refresh()
+
+    def _refresh_on_miss(self):
+        """
+        Reloads the catalog after a lookup missed, in case the item was created since the last load.
+        Rate limited so lookups of items that really don't exist can't hammer the DB.
+        """
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.miss_refresh_interval:
+                self.refresh()
+
+    def get_source_field(self, sfid: int) -> SourceField:
+        self._ensure_loaded()
+        if sfid not in self.source_fields:
+            self._refresh_on_miss()
+        return self.source_fields[sfid]
+
+    def get_metric(self, metric_id: int) -> Metric:
+        self._ensure_loaded()
+        return self.metrics[metric_id]
+
+    def get_projection(self, proj_id: int) -> Projection:
+        self._ensure_loaded()
+        if proj_id not in self.projections:
+            self._refresh_on_miss()
+        return self.projections[proj_id]
+
+    def get_source_fields(self, metric_ids: Optional[Iterable[int]] = None, ingested_only: bool = True) -> List[SourceField]:
+        """
+        Returns all source fields, optionally limited to those for the given metrics.
+        :param ingested_only: Only return source fields which have a projection (i.e. have been ingested)
+        """
+        self._ensure_loaded()
+
+        if metric_ids is not None:
+            metric_ids = set(metric_ids)
+
+        return [
+            sf for sf in self.source_fields.values()
+            if (metric_ids is None or sf.metric_id in metric_ids)
+            and (not ingested_only or sf.projection_id is not None)
+        ]
+
+
+catalog = MetadataCatalog(Config.METADATA_CATALOG_TTL)
@@ -9,9 +9,29 @@ class Config():
     POSTGRES_DB = os.environ.get('POSTGRES_DB', 'postgres')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     DATA_PROVIDER = "MONGO"
+    INGEST_S3_CONNECT_TIMEOUT = float(os.environ.get('INGEST_S3_CONNECT_TIMEOUT', 5))
+    INGEST_S3_READ_TIMEOUT = float(os.environ.get('INGEST_S3_READ_TIMEOUT', 30))
+    INGEST_S3_BLOCK_SIZE = int(os.environ.get('INGEST_S3_BLOCK_SIZE', 0))
+    INGEST_S3_QUANTIZE = os.environ.get('INGEST_S3_QUANTIZE', '0') == '1'
+    INGEST_DOWNLOAD_WORKERS = int(os.environ.get('INGEST_DOWNLOAD_WORKERS', 8))
+    INGEST_DECODE_WORKERS = int(os.environ.get('INGEST_DECODE_WORKERS', 2))
+    INGEST_DECODE_PROCESSES = int(os.environ.get('INGEST_DECODE_PROCESSES', os.cpu_count() or 1))
+    INGEST_WRITE_WORKERS = int(os.environ.get('INGEST_WRITE_WORKERS', 2))
+    INGEST_STAGE_QUEUE_SIZE = int(os.environ.get('INGEST_STAGE_QUEUE_SIZE', 4))
+    GRIB_CACHE_DIR = os.environ.get('GRIB_CACHE_DIR', '/tmp/wx_explore/grib_ranges')
+    GRIB_CACHE_MAX_BYTES = int(os.environ.get('GRIB_CACHE_MAX_BYTES', 2 * 1024**3))
     INGEST_MONGO_SERVER_URI = os.environ.get('INGEST_MONGO_SERVER_URI', 'mongodb://localhost:27017/')
     INGEST_MONGO_DATABASE = os.environ.get('INGEST_MONGO_DATABASE', 'wx')
     INGEST_MONGO_COLLECTION = os.environ.get('INGEST_MONGO_COLLECTION', 'wx')
+    INGEST_MONGO_BUCKETED = os.environ.get('INGEST_MONGO_BUCKETED', '0') == '1'
+    INGEST_SHARD_ENCODING = os.environ.get('INGEST_SHARD_ENCODING', 'zlib')
+    METADATA_CATALOG_TTL = float(os.environ.get('METADATA_CATALOG_TTL', 300))
+    PROJECTION_CACHE_DIR = os.environ.get('PROJECTION_CACHE_DIR', '/tmp/wx_explore/projections')
+    DATA_VERSION_TTL = float(os.environ.get('DATA_VERSION_TTL', 15))
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 10000))
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+    RESPONSE_CACHE_TIME_BUCKET = int(os.environ.get('RESPONSE_CACHE_TIME_BUCKET', 300))
+    RESPONSE_CACHE_REDIS_URL = os.environ.get('RESPONSE_CACHE_REDIS_URL', None)
     SENTRY_ENDPOINT = os.environ.get('SENTRY_ENDPOINT', None)
 
 Config.SQLALCHEMY_DATABASE_URI = f"postgresql://{Config.POSTGRES_USER}:{Config.POSTGRES_PASS}@{Config.POSTGRES_HOST}:{Config.POSTGRES_PORT}/{Config.POSTGRES_DB}"
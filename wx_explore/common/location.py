@@ -1,21 +1,129 @@
-import math
+from scipy.spatial import cKDTree
+from typing import Dict, Optional, Tuple
+
+import logging
 import numpy
+import os
 
+from wx_explore.common.config import Config
 from wx_explore.common.models import Projection
 from wx_explore.web.core import app, db
 
+logger = logging.getLogger(__name__)
+
+# Number of nearest grid cells (by great-circle chord) which are re-ranked
+# using the lat/lon distance the original grid walk used.
+N_CANDIDATES = 4
+
+
+class CoordinateLookup(object):
+    """
+    Spatial index over the lat/lon of every grid cell in a projection.
+
+    Grid cells are placed on the unit sphere so that nearest-neighbor queries
+    are correct across the antimeridian and on curved (e.g. Lambert) grids.
+    """
+    lats: numpy.ndarray
+    lons: numpy.ndarray
+    tree: cKDTree
+    bounds: Tuple[float, float, float, float]  # lat_min, lat_max, lon_min, lon_max
+
+    def __init__(self, lats: numpy.ndarray, lons: numpy.ndarray):
+        self.lats = lats
+        self.lons = lons
+        self.tree = cKDTree(to_unit_sphere(lats, lons).reshape(-1, 3))
+        self.bounds = (lats.min(), lats.max(), lons.min(), lons.max())
+
+    def contains(self, lat: float, lon: float) -> bool:
+        lat_min, lat_max, lon_min, lon_max = self.bounds
+        return lat_min <= lat <= lat_max and lon_min <= lon <= lon_max
+
+    def nearest(self, lat: float, lon: float) -> Tuple[int, int]:
+        """
+        Returns the (x, y) of the grid cell nearest to the given (lat, lon)
+        """
+        _, idxs = self.tree.query(to_unit_sphere(lat, lon), k=N_CANDIDATES)
+        idxs = numpy.atleast_1d(idxs)
+        idxs = idxs[idxs < self.tree.n]
 
-lut_meta = {}
+        flat_lats = self.lats.reshape(-1)
+        flat_lons = self.lons.reshape(-1)
+        dists = (flat_lats[idxs] - lat)**2 + (flat_lons[idxs] - lon)**2
+        # Ties go to the lowest index, matching a row-major scan of the grid
+        best = min(zip(dists, idxs))[1]
 
+        y, x = divmod(int(best), self.lats.shape[1])
+        return (x, y)
 
-def load_coordinate_lookup_meta(proj):
-    lats = numpy.array(proj.lats)
-    lons = numpy.array(proj.lons)
 
-    return (lats, lons)
+lut_meta: Dict[int, CoordinateLookup] = {}
+
+
+def to_unit_sphere(lats, lons) -> numpy.ndarray:
+    """
+    Converts lat/lon (in degrees) to cartesian coordinates on the unit sphere.
+    Output has shape (*lats.shape, 3)
+    """
+    lats = numpy.radians(lats)
+    lons = numpy.radians(lons)
+    cos_lats = numpy.cos(lats)
+    return numpy.stack([cos_lats * numpy.cos(lons), cos_lats * numpy.sin(lons), numpy.sin(lats)], axis=-1)
+
+
+def _grid_cache_paths(proj) -> Tuple[str, str]:
+    base = os.path.join(Config.PROJECTION_CACHE_DIR, f"{proj.id}-{proj.ll_hash}")
+    return (f"{base}-lats.npy", f"{base}-lons.npy")
+
+
+def save_projection_grid(proj, lats, lons):
+    """
+    Writes the lat/lon grids of the given projection to the on-disk cache
+    so later lookups can mmap them instead of loading them from the DB.
+    """
+    os.makedirs(Config.PROJECTION_CACHE_DIR, exist_ok=True)
 
+    for path, grid in zip(_grid_cache_paths(proj), (lats, lons)):
+        # Write to a temp file and rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            numpy.save(f, numpy.asarray(grid, dtype=numpy.float32))
+        os.replace(tmp_path, path)
 
-def get_lookup_meta(proj):
+
+def load_projection_grid(proj) -> Optional[Tuple[numpy.ndarray, numpy.ndarray]]:
+    """
+    Memory maps the cached lat/lon grids of the given projection,
+    or returns None if they haven't been cached yet.
+    """
+    lats_path, lons_path = _grid_cache_paths(proj)
+
+    try:
+        return (numpy.load(lats_path, mmap_mode='r'), numpy.load(lons_path, mmap_mode='r'))
+    except FileNotFoundError:
+        return None
+
+
+def load_coordinate_lookup_meta(proj) -> CoordinateLookup:
+    grid = load_projection_grid(proj)
+
+    if grid is None:
+        logger.info("Projection %d is not cached on disk, loading from DB", proj.id)
+        # Query the columns directly since proj may be detached (e.g. from the catalog)
+        lats, lons = db.session.query(Projection.lats, Projection.lons).filter(Projection.id == proj.id).one()
+        grid = (
+            numpy.array(lats, dtype=numpy.float32),
+            numpy.array(lons, dtype=numpy.float32),
+        )
+
+        try:
+            save_projection_grid(proj, *grid)
+        except OSError:
+            logger.exception("Unable to cache projection %d on disk", proj.id)
+
+    return CoordinateLookup(*grid)
+
+
+def get_lookup_meta(proj) -> CoordinateLookup:
     if proj.id not in lut_meta:
         lut_meta[proj.id] = load_coordinate_lookup_meta(proj)
     return lut_meta[proj.id]
@@ -31,43 +139,18 @@ def preload_coordinate_lookup_meta():
 
 
 def clear_proj_cache():
-    for k in lut_meta:
-        del lut_meta[k]
-
+    lut_meta.clear()
 
-def _dist(x, y, lat, lon, projlats, projlons):
-    return math.sqrt((lat - projlats[y][x])**2 + (lon - projlons[y][x])**2)
 
-
-def get_xy_for_coord(proj, coords):
+def get_xy_for_coord(proj, coords) -> Optional[Tuple[int, int]]:
     """
     Returns the x,y for a given (lat, lon) coordinate on the given projection
     """
-    projlats, projlons = get_lookup_meta(proj)
+    lookup = get_lookup_meta(proj)
 
     lat, lon = coords
 
-    if not (projlons.min() <= lon <= projlons.max() and projlats.min() <= lat <= projlats.max()):
+    if not lookup.contains(lat, lon):
         return None
 
-    x = proj.n_x // 2
-    y = proj.n_y // 2
-
-    # Dumb walk to figure out best x,y
-    # Easier on memory than keeping kdtrees and not that much slower since we don't hit this very often
-    while True:
-        best = (None, None, None)  # dist, dx, dy
-
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                dist = _dist((x + dx) % proj.n_x, (y + dy) % proj.n_y, lat, lon, projlats, projlons)
-                if best[0] is None or dist < best[0]:
-                    best = (dist, dx, dy)
-
-        if best[1] == 0 and best[2] == 0:
-            break
-
-        x = (x + best[1]) % proj.n_x
-        y = (y + best[2]) % proj.n_y
-
-    return (x, y)
+    return lookup.nearest(lat, lon)
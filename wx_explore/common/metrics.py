@@ -65,6 +65,18 @@ with app.app_context():
         name='Cloud Cover',
         units='%',
     ))
+    relative_humidity = get_or_create(Metric(
+        name='2m Relative Humidity',
+        units='%',
+    ))
+    dewpoint = get_or_create(Metric(
+        name='2m Dewpoint',
+        units='K',
+    ))
+    apparent_temp = get_or_create(Metric(
+        name='2m Apparent Temperature',
+        units='K',
+    ))
 
 ALL_METRICS = [
     temp,
@@ -82,4 +94,7 @@ ALL_METRICS = [
     wind_direction,
     gust_speed,
     cloud_cover,
+    relative_humidity,
+    dewpoint,
+    apparent_temp,
 ]
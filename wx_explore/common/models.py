@@ -7,17 +7,17 @@ from sqlalchemy import (
     String,
     Boolean,
     DateTime,
+    Float,
     ForeignKey,
     UniqueConstraint,
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.ext.declarative import declarative_base
-from typing import List, Optional
+from typing import Callable, Iterable, Iterator, List, Optional, Union
 
 import datetime
 import numpy
-import statistics
 
 
 Base = declarative_base()
@@ -184,6 +184,8 @@ class FileMeta(Base):
     projection_id = Column(Integer, ForeignKey('projection.id'))
     ctime = Column(DateTime, default=datetime.datetime.utcnow)
     loc_size = Column(Integer, nullable=False)
+    # Number of locations per compressed block, or NULL if stripes are stored uncompressed
+    block_size = Column(Integer, nullable=True)
 
     projection = relationship('Projection')
 
@@ -202,6 +204,12 @@ class FileBandMeta(Base):
     # Metadata used to seek into the file
     vals_per_loc = Column(Integer)
 
+    # How values are stored (see ENCODINGS). NULL is plain float32.
+    # Scaled encodings are decoded as raw * scale + add_offset
+    encoding = Column(String(8))
+    scale = Column(Float)
+    add_offset = Column(Float)
+
     # Metadata
     source_field_id = Column(Integer, ForeignKey('source_field.id'))
     valid_time = Column(DateTime)
@@ -210,12 +218,87 @@ class FileBandMeta(Base):
     file_meta = relationship('FileMeta', backref='bands', lazy='joined')
     source_field = relationship('SourceField', lazy='joined')
 
+    # Map of encoding to the dtype values are stored as
+    ENCODINGS = {
+        None: numpy.float32,
+        'u1': numpy.uint8,
+        'i2': numpy.int16,
+    }
+    # Stored (in place of NaN) for missing values in 'u1' and 'i2' bands
+    U1_MISSING = 255
+    I2_MISSING = -32768
+
+    @property
+    def dtype(self) -> numpy.dtype:
+        return numpy.dtype(self.ENCODINGS[self.encoding])
+
+    @property
+    def size(self) -> int:
+        """
+        Number of bytes used by this band in each location's chunk
+        """
+        return self.dtype.itemsize * self.vals_per_loc
+
+    def decode(self, raw: numpy.ndarray) -> numpy.ndarray:
+        """
+        Converts values as stored (with this band's dtype) to float32
+        """
+        if self.encoding is None:
+            return raw
+
+        if self.encoding == 'i2':
+            vals = (raw * self.scale + self.add_offset).astype(numpy.float32)
+            vals[raw == self.I2_MISSING] = numpy.nan
+            return vals
+
+        vals = raw.astype(numpy.float32)
+        vals[raw == self.U1_MISSING] = numpy.nan
+        return vals
+
+
+class MergeJob(Base):
+    """
+    Table that holds a merge of files into file_name which hasn't finished yet.
+    The plan is kept so that an interrupted merge can be resumed with the exact same layout.
+    """
+    __tablename__ = "merge_job"
+
+    file_name = Column(String, ForeignKey('file_meta.file_name'), primary_key=True)
+    # List of [source file name, source offset, size, new offset] of each band being moved, in order
+    bands = Column(JSONB, nullable=False)
+    # Number of times merging has been attempted
+    tries = Column(Integer, nullable=False, default=0)
+
+    file_meta = relationship('FileMeta')
+
+
+class MergeProgress(Base):
+    """
+    Table that holds which stripes (rows) of a merge job's file have been uploaded.
+    """
+    __tablename__ = "merge_progress"
+
+    file_name = Column(String, ForeignKey('merge_job.file_name'), primary_key=True)
+    y = Column(Integer, primary_key=True)
+
+
+class DataVersion(Base):
+    """
+    Single row table holding a counter which is bumped whenever new data is
+    saved (or existing data is rewritten), used to invalidate cached responses.
+    """
+    __tablename__ = "data_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated = Column(DateTime, default=datetime.datetime.utcnow)
+
 
 class DataPointSet(object):
     """
     Non-db object which holds values and metadata for given data point (loc, time)
     """
-    values: List[float]
+    values: Union[List[float], numpy.ndarray]
     metric_id: int
     valid_time: datetime.datetime
     source_field_id: Optional[int]
@@ -225,7 +308,7 @@ class DataPointSet(object):
 
     def __init__(
             self,
-            values: List[float],
+            values: Union[List[float], numpy.ndarray],
             metric_id: int,
             valid_time: datetime.datetime,
             source_field_id: Optional[int] = None,
@@ -246,23 +329,147 @@ class DataPointSet(object):
         return f"<DataPointSet metric_id={self.metric_id} valid_time={self.valid_time} source_field_id={self.source_field_id} derived={self.derived} synthesized={self.synthesized}>"
 
     def min(self) -> float:
-        return min(self.values)
+        return float(numpy.min(self.values))
 
     def max(self) -> float:
-        return max(self.values)
+        return float(numpy.max(self.values))
 
     def median(self) -> float:
-        return statistics.median(self.values)
+        return float(numpy.median(self.values))
 
     def median_confidence(self) -> float:
-        vals = numpy.array(self.values)
-        n_within_stddev = (abs(vals - self.median()) < numpy.std(vals)).sum()
+        vals = numpy.asarray(self.values)
+        n_within_stddev = (abs(vals - numpy.median(vals)) < numpy.std(vals)).sum()
         return n_within_stddev / len(vals)
 
     def mean(self) -> float:
-        return statistics.mean(self.values)
+        return float(numpy.mean(self.values))
 
     def mean_confidence(self) -> float:
-        vals = numpy.array(self.values)
-        n_within_stddev = (abs(vals - self.mean()) < numpy.std(vals)).sum()
+        vals = numpy.asarray(self.values)
+        n_within_stddev = (abs(vals - numpy.mean(vals)) < numpy.std(vals)).sum()
         return n_within_stddev / len(vals)
+
+
+class DataPointBatch(object):
+    """
+    Non-db columnar store of many data points, so stats can be computed for all of them at once.
+
+    Values for all points are kept in one flat array, with point i's values being
+    values[offsets[i]:offsets[i+1]]. Indexing or iterating gives DataPointSet views
+    over the batch.
+    """
+    values: numpy.ndarray
+    offsets: numpy.ndarray
+    metric_ids: numpy.ndarray
+    valid_times: numpy.ndarray
+    source_field_ids: numpy.ndarray
+    run_times: numpy.ndarray
+    derived: numpy.ndarray
+    synthesized: numpy.ndarray
+
+    def __init__(
+            self,
+            values: numpy.ndarray,
+            offsets: numpy.ndarray,
+            metric_ids: numpy.ndarray,
+            valid_times: numpy.ndarray,
+            source_field_ids: numpy.ndarray,
+            run_times: numpy.ndarray,
+            derived: numpy.ndarray,
+            synthesized: numpy.ndarray):
+        self.values = values
+        self.offsets = offsets
+        self.metric_ids = metric_ids
+        self.valid_times = valid_times
+        self.source_field_ids = source_field_ids
+        self.run_times = run_times
+        self.derived = derived
+        self.synthesized = synthesized
+
+    @classmethod
+    def from_data_points(cls, data_points: Iterable[DataPointSet]) -> 'DataPointBatch':
+        data_points = list(data_points)
+        value_arrs = [numpy.asarray(dp.values, dtype=numpy.float32) for dp in data_points]
+
+        offsets = numpy.zeros(len(data_points) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(vals) for vals in value_arrs], out=offsets[1:])
+
+        return cls(
+            values=numpy.concatenate(value_arrs) if value_arrs else numpy.empty(0, dtype=numpy.float32),
+            offsets=offsets,
+            metric_ids=numpy.array([dp.metric_id for dp in data_points], dtype=numpy.int64),
+            # Object arrays since these can be None, and to keep tz-aware datetimes as-is
+            valid_times=numpy.array([dp.valid_time for dp in data_points], dtype=object),
+            source_field_ids=numpy.array([dp.source_field_id for dp in data_points], dtype=object),
+            run_times=numpy.array([dp.run_time for dp in data_points], dtype=object),
+            derived=numpy.array([dp.derived for dp in data_points], dtype=bool),
+            synthesized=numpy.array([dp.synthesized for dp in data_points], dtype=bool),
+        )
+
+    def __len__(self) -> int:
+        return len(self.metric_ids)
+
+    def __getitem__(self, i: int) -> DataPointSet:
+        return DataPointSet(
+            values=self.values[self.offsets[i]:self.offsets[i+1]],
+            metric_id=int(self.metric_ids[i]),
+            valid_time=self.valid_times[i],
+            source_field_id=self.source_field_ids[i],
+            run_time=self.run_times[i],
+            derived=bool(self.derived[i]),
+            synthesized=bool(self.synthesized[i]),
+        )
+
+    def __iter__(self) -> Iterator[DataPointSet]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self) -> numpy.ndarray:
+        return numpy.diff(self.offsets)
+
+    def _reduce(self, func: Callable[[numpy.ndarray], numpy.ndarray]) -> numpy.ndarray:
+        """
+        Applies func (which takes a 2d array and reduces along axis 1) to the values of every point.
+        Points are grouped by number of values so each group is reduced in one call.
+        """
+        lengths = self.lengths()
+        out = numpy.full(len(self), numpy.nan)
+
+        for length in numpy.unique(lengths):
+            if length == 0:
+                continue
+
+            idxs = numpy.nonzero(lengths == length)[0]
+            vals = self.values[self.offsets[idxs, None] + numpy.arange(length)]
+            out[idxs] = func(vals)
+
+        return out
+
+    def mins(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: vals.min(axis=1))
+
+    def maxs(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: vals.max(axis=1))
+
+    def medians(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: numpy.median(vals, axis=1))
+
+    def means(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: vals.mean(axis=1))
+
+    def stds(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: vals.std(axis=1))
+
+    def spreads(self) -> numpy.ndarray:
+        return self.maxs() - self.mins()
+
+    def median_confidences(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: (
+            abs(vals - numpy.median(vals, axis=1, keepdims=True)) < vals.std(axis=1, keepdims=True)
+        ).mean(axis=1))
+
+    def mean_confidences(self) -> numpy.ndarray:
+        return self._reduce(lambda vals: (
+            abs(vals - vals.mean(axis=1, keepdims=True)) < vals.std(axis=1, keepdims=True)
+        ).mean(axis=1))
@@ -0,0 +1,39 @@
+from sqlalchemy import Column, inspect, text
+from sqlalchemy.engine import Engine
+from typing import List
+
+import logging
+
+from wx_explore.common.models import FileBandMeta, FileMeta
+
+logger = logging.getLogger(__name__)
+
+# Columns added to tables after they were first created.
+# db.create_all() only creates missing tables, so these are added to existing databases by upgrade_schema.
+# All of them must be nullable (with NULL keeping the old behavior) since existing rows get NULL.
+ADDED_COLUMNS: List[Column] = [
+    FileMeta.__table__.c.block_size,
+    # NULL encoding is plain float32 (and scale/add_offset are only used by scaled encodings)
+    FileBandMeta.__table__.c.encoding,
+    FileBandMeta.__table__.c.scale,
+    FileBandMeta.__table__.c.add_offset,
+]
+
+
+def upgrade_schema(engine: Engine):
+    """
+    Adds any of ADDED_COLUMNS missing from the (already created) tables.
+    Safe to run concurrently (e.g. by every process on startup).
+    """
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for column in ADDED_COLUMNS:
+            table = column.table.name
+            if column.name in {c['name'] for c in inspector.get_columns(table)}:
+                continue
+
+            logger.info("Adding column %s.%s", table, column.name)
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column.name} {column.type.compile(dialect=engine.dialect)}"
+            ))
@@ -155,6 +155,20 @@ def seed():
                     'typeOfLevel': 'atmosphere',
                 },
             },
+            # Derived from other fields at ingest (see ingest/derived.py).
+            # No idx fields so they're never downloaded, even if a source has them.
+            '2m Relative Humidity': {
+                'idx_short_name': None,
+                'idx_level': None,
+            },
+            '2m Dewpoint': {
+                'idx_short_name': None,
+                'idx_level': None,
+            },
+            '2m Apparent Temperature': {
+                'idx_short_name': None,
+                'idx_level': None,
+            },
         }
 
         for src in sources:
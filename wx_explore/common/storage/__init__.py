@@ -1,10 +1,15 @@
-from typing import Tuple, Optional, Iterable, Dict, List
+from typing import Callable, Tuple, Optional, Iterable, Dict, List
 
+import atexit
+import collections
 import concurrent.futures
 import datetime
 import numpy
+import os
+import threading
 
 from wx_explore.common import tracing
+from wx_explore.common.catalog import catalog
 from wx_explore.common.config import Config
 from wx_explore.common.location import get_xy_for_coord
 from wx_explore.common.models import (
@@ -25,6 +30,36 @@ class DataProvider(object):
     ) -> List[DataPointSet]:
         raise NotImplementedError()
 
+    def get_fields_batch(
+            self,
+            proj_id: int,
+            locs: List[Tuple[float, float]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> Dict[Tuple[float, float], List[DataPointSet]]:
+        """
+        Loads data for many locations in a single projection.
+        Backends should override this to share reads between locations that are stored together.
+        """
+        return {loc: self.get_fields(proj_id, loc, valid_source_fields, start, end) for loc in set(locs)}
+
+    def prepare_fields_batch(
+            self,
+            proj_id: int,
+            locs: List[Tuple[float, float]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> Callable[[], Dict[Tuple[float, float], List[DataPointSet]]]:
+        """
+        Does any metadata (DB) lookups needed by get_fields_batch on the calling thread.
+        Backends which look anything up in the DB must override this.
+        :return: Function which loads the data (as get_fields_batch would). It may be called on another
+                 thread (without an app context), so it must not touch the DB.
+        """
+        return lambda: self.get_fields_batch(proj_id, locs, valid_source_fields, start, end)
+
     def put_fields(
             self,
             proj: Projection,
@@ -38,79 +73,191 @@ class DataProvider(object):
     def merge(self):
         raise NotImplementedError()
 
+    def close(self):
+        """
+        Releases any connections held by this provider.
+        """
+        pass
+
+
+_provider: Optional[DataProvider] = None
+_provider_pid: Optional[int] = None
+_provider_lock = threading.Lock()
+
+
+def get_provider() -> DataProvider:
+    """
+    Returns the process-wide data provider, creating it on first use.
+
+    Providers hold connection pools (and for Mongo, an index check on creation)
+    so they should be shared instead of created per request.
+    A new provider is created after a fork since connections can't be shared
+    between processes (e.g. gunicorn workers forked from a preloaded app).
+    """
+    global _provider, _provider_pid
+
+    with _provider_lock:
+        if _provider is None or _provider_pid != os.getpid():
+            _provider = create_provider()
+            _provider_pid = os.getpid()
+
+        return _provider
+
+
+def close_provider():
+    """
+    Closes the process-wide data provider (if one was created by this process).
+    """
+    global _provider, _provider_pid
+
+    with _provider_lock:
+        if _provider is not None and _provider_pid == os.getpid():
+            _provider.close()
+        _provider = None
+        _provider_pid = None
 
-def get_provider():
+
+atexit.register(close_provider)
+
+
+# Number of projections loaded concurrently (across all requests)
+PROJECTION_LOAD_WORKERS = 16
+
+_load_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_load_executor_pid: Optional[int] = None
+_load_executor_lock = threading.Lock()
+
+
+def get_load_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Returns the process-wide pool which projections are loaded on.
+    This is separate from the event loop's default executor since loads block on
+    the loop (which needs that executor for e.g. DNS resolution).
+    """
+    global _load_executor, _load_executor_pid
+
+    with _load_executor_lock:
+        if _load_executor is None or _load_executor_pid != os.getpid():
+            _load_executor = concurrent.futures.ThreadPoolExecutor(PROJECTION_LOAD_WORKERS, thread_name_prefix='load-projection')
+            _load_executor_pid = os.getpid()
+
+        return _load_executor
+
+
+def create_provider() -> DataProvider:
     from .s3 import S3Backend
+    from .s3_series import S3SeriesBackend
     from .azure_tables import AzureTableBackend
     from .mongo import MongoBackend
 
-    if Config.DATA_PROVIDER == "S3":
-        return S3Backend(
+    if Config.DATA_PROVIDER in ("S3", "S3_SERIES"):
+        backend = S3SeriesBackend if Config.DATA_PROVIDER == "S3_SERIES" else S3Backend
+        return backend(
             Config.INGEST_S3_ACCESS_KEY,
             Config.INGEST_S3_SECRET_KEY,
             Config.INGEST_S3_REGION,
             Config.INGEST_S3_BUCKET,
             Config.INGEST_S3_ENDPOINT,
+            Config.INGEST_S3_CONNECT_TIMEOUT,
+            Config.INGEST_S3_READ_TIMEOUT,
+            Config.INGEST_S3_BLOCK_SIZE,
+            Config.INGEST_S3_QUANTIZE,
         )
     elif Config.DATA_PROVIDER == "AZURE_TABLES":
         return AzureTableBackend(
             Config.INGEST_AZURE_TABLE_ACCOUNT_NAME,
             Config.INGEST_AZURE_TABLE_ACCOUNT_KEY,
             Config.INGEST_AZURE_TABLE_NAME,
+            Config.INGEST_SHARD_ENCODING,
         )
     elif Config.DATA_PROVIDER == "MONGO":
         return MongoBackend(
             Config.INGEST_MONGO_SERVER_URI,
             Config.INGEST_MONGO_DATABASE,
             Config.INGEST_MONGO_COLLECTION,
+            Config.INGEST_SHARD_ENCODING,
+            Config.INGEST_MONGO_BUCKETED,
         )
 
 
+def get_grid_cells(
+        coords: Tuple[float, float],
+        source_fields: Iterable[SourceField]
+) -> List[Tuple[int, int, int]]:
+    """
+    Returns the (projection id, x, y) of the grid cell containing coords in each projection
+    used by source_fields (skipping projections which don't cover coords).
+    Data loaded for coords depends only on these cells, so they can be used as a cache key.
+    """
+    cells = []
+
+    for proj in {sf.projection_id: sf.projection for sf in source_fields if sf.projection_id is not None}.values():
+        loc = get_xy_for_coord(proj, coords)
+        if loc is not None:
+            cells.append((proj.id, *loc))
+
+    return sorted(cells)
+
+
 def load_data_points(
         coords: Tuple[float, float],
         start: datetime.datetime,
         end: datetime.datetime,
         source_fields: Optional[Iterable[SourceField]] = None
 ) -> List[DataPointSet]:
-    
-    print(coords, start, end, source_fields)
+    return load_data_points_batch([coords], start, end, source_fields)[0]
+
 
+def load_data_points_batch(
+        coords_list: List[Tuple[float, float]],
+        start: datetime.datetime,
+        end: datetime.datetime,
+        source_fields: Optional[Iterable[SourceField]] = None
+) -> List[List[DataPointSet]]:
+    """
+    Loads data points for each of the given (lat, lon) coordinates.
+    Coordinates which fall in the same grid cell (or are stored near each other)
+    are loaded together, so this is much cheaper than calling load_data_points
+    once per coordinate.
+    :return: List of data points for each of coords_list, in the same order
+    """
     if source_fields is None or source_fields == []:
-        source_fields = SourceField.query.all()
+        source_fields = catalog.get_source_fields()
 
-    # Determine all valid source fields (fields in source_fields which cover the given coords),
-    # and the x,y for projection used in any valid source field.
-    valid_source_fields = []
-    locs: Dict[int, Tuple[float, float]] = {}
+    # Group source fields by projection, skipping any which haven't been ingested yet
+    proj_source_fields: Dict[int, List[SourceField]] = collections.defaultdict(list)
+    projections: Dict[int, Projection] = {}
     for sf in source_fields:
         if sf.projection_id is None:
             continue
 
-        if sf.projection_id in locs and locs[sf.projection_id] is None:
-            continue
-        if sf.projection_id not in locs:
-            with tracing.start_span("get_xy_for_coord") as span:
-                span.set_attribute("projection_id", sf.projection_id)
-                print(sf.projection_id)
-                loc = get_xy_for_coord(sf.projection, coords)
+        proj_source_fields[sf.projection_id].append(sf)
+        projections[sf.projection_id] = sf.projection
 
-            # Skip if given projection does not cover coords
-            if loc is None:
-                continue
+    # Determine the x,y for each coord in each projection (None if the projection doesn't cover coords)
+    locs: Dict[int, List[Optional[Tuple[int, int]]]] = {}
+    for proj_id, proj in projections.items():
+        with tracing.start_span("get_xy_for_coord") as span:
+            span.set_attribute("projection_id", proj_id)
+            span.set_attribute("num_coords", len(coords_list))
+            locs[proj_id] = [get_xy_for_coord(proj, coords) for coords in coords_list]
 
-            print(loc)
+    # DB lookups happen here, on the request thread, and only the loads themselves are run on the pool
+    loads = {}
+    for proj_id in projections:
+        proj_locs = set(loc for loc in locs[proj_id] if loc is not None)
+        if proj_locs:
+            loads[proj_id] = get_provider().prepare_fields_batch(proj_id, list(proj_locs), proj_source_fields[proj_id], start, end)
 
-            locs[sf.projection_id] = loc
+    executor = get_load_executor()
+    futures = {proj_id: executor.submit(load) for proj_id, load in loads.items()}
 
-        valid_source_fields.append(sf)
+    data_points: List[List[DataPointSet]] = [[] for _ in coords_list]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(locs)) as ex:
-        data_points: List[DataPointSet] = sum(
-            ex.map(
-                lambda proj_loc: get_provider().get_fields(*proj_loc, valid_source_fields, start, end),
-                locs.items()
-            ),
-            [],
-        )
+    for proj_id, future in futures.items():
+        loc_data_points = future.result()
+        for i, loc in enumerate(locs[proj_id]):
+            if loc is not None:
+                data_points[i].extend(loc_data_points[loc])
 
     return data_points
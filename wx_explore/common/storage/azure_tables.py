@@ -5,16 +5,19 @@ from azure.cosmosdb.table import (
     EdmType,
     TableBatch,
 )
-from typing import Dict, Tuple, List
+from typing import Deque, Dict, Tuple, List, Sequence
 
-import array
+import collections
 import concurrent.futures
 import datetime
 import logging
+import math
 import numpy
-import zlib
+import threading
+import time
 
 from . import DataProvider
+from .shards import encode_shard, decode_shard
 from wx_explore.common.models import (
     Projection,
     SourceField,
@@ -33,7 +36,7 @@ class AzureTableBackend(DataProvider):
     We use the following:
         * pk is (proj_id, y)
         * row is (valid_time, run_time, x_shard)
-        * properties are "sf{n}" -> zlib'd bytearr value for each x in the shard
+        * properties are "sf{n}" -> encoded (see shards.encode_shard) float32 value for each x in the shard
 
     This means:
         * Location queries are always on a single partition
@@ -47,8 +50,25 @@ class AzureTableBackend(DataProvider):
     account_key: str
     table_name: str
     n_x_per_row: int = 128
-
-    def __init__(self, account_name, account_key, table_name):
+    # Max number of batches being committed at once in put_fields (and partitions cleaned at once)
+    write_parallelism: int = 16
+    # Max number of rows being built (or built and waiting to be queued), per put_fields call
+    max_pending_builds: int = 16
+    # Max number of built batches waiting to be committed, per put_fields call
+    max_queued_batches: int = 64
+    # Number of times a failed batch is retried before put_fields gives up
+    batch_retries: int = 3
+    # Reads are split into up to read_parallelism time ranges (queried concurrently),
+    # each covering at least min_read_hours
+    read_parallelism: int = 8
+    min_read_hours: int = 3
+    # Number of threads (and so clients) shared by all reads
+    read_pool_size: int = 32
+
+    def __init__(self, account_name, account_key, table_name, shard_encoding='zlib'):
+        """
+        :param shard_encoding: How new shards are stored (see shards.encode_shard)
+        """
         logging.getLogger('azure').setLevel(logging.WARNING)
         logging.getLogger('urllib3').setLevel(logging.ERROR)
 
@@ -56,6 +76,29 @@ class AzureTableBackend(DataProvider):
         self.account_name = account_name
         self.account_key = account_key
         self.table_name = table_name
+        self.shard_encoding = shard_encoding
+
+        self._local = threading.local()
+
+        # Long-lived pools so each of their threads' clients (and connections)
+        # are reused across calls rather than dying with a per-call pool
+        self._read_executor = concurrent.futures.ThreadPoolExecutor(self.read_pool_size, thread_name_prefix='azure-read')
+        self._write_executor = concurrent.futures.ThreadPoolExecutor(self.write_parallelism, thread_name_prefix='azure-write')
+
+    def close(self):
+        self._read_executor.shutdown()
+        self._write_executor.shutdown()
+
+    def _table_service(self) -> TableService:
+        """
+        Returns this thread's client. Only used from the backend's long-lived pools
+        (and callers' own threads), so clients are reused across requests.
+        """
+        svc = getattr(self._local, 'svc', None)
+        if svc is None:
+            svc = TableService(self.account_name, self.account_key)
+            self._local.svc = svc
+        return svc
 
     def get_fields(
             self,
@@ -68,21 +111,22 @@ class AzureTableBackend(DataProvider):
         start = start.replace(microsecond=0)
         end = end.replace(microsecond=0)
 
-        parallel_hours = 3
+        # Short windows are a single query, long ones are split into at most read_parallelism ranges
+        window_hours = (end - start).total_seconds() / 3600
+        parallel_hours = max(self.min_read_hours, math.ceil(window_hours / self.read_parallelism))
 
         times = [start]
         while times[-1] + datetime.timedelta(hours=parallel_hours) < end:
             times.append(times[-1] + datetime.timedelta(hours=parallel_hours))
         times.append(end)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(times)-1) as ex:
-            return sum(
-                ex.map(
-                    lambda time_range: self._get_fields_worker(proj_id, loc, valid_source_fields, *time_range),
-                    zip(times[:-1], times[1:]),
-                ),
-                [],
-            )
+        return sum(
+            self._read_executor.map(
+                lambda time_range: self._get_fields_worker(proj_id, loc, valid_source_fields, *time_range),
+                zip(times[:-1], times[1:]),
+            ),
+            [],
+        )
 
     def _get_fields_worker(
             self,
@@ -107,17 +151,14 @@ class AzureTableBackend(DataProvider):
 
         data_points = []
 
-        for row in TableService(self.account_name, self.account_key).query_entities(self.table_name, az_filter, ','.join(select)):
+        for row in self._table_service().query_entities(self.table_name, az_filter, ','.join(select)):
             for sf in valid_source_fields:
                 key = f"sf{sf.id}"
                 if key not in row or row[key] is None:
                     continue
 
-                raw = zlib.decompress(row[key].value)
-                val = array.array("f", raw).tolist()[rel_x]
-
                 data_point = DataPointSet(
-                    values=[val],
+                    values=decode_shard(row[key].value, [rel_x]),
                     metric_id=sf.metric.id,
                     valid_time=row.ValidTime,
                     source_field_id=sf.id,
@@ -134,15 +175,67 @@ class AzureTableBackend(DataProvider):
             fields: Dict[Tuple[int, datetime.datetime, datetime.datetime], List[numpy.array]]
     ):
         # fields is map of (field_id, valid_time, run_time) -> [msg, ...]
-        with concurrent.futures.ThreadPoolExecutor() as ex:
-            ex.map(lambda y: self._put_fields_worker(proj, fields, y), range(proj.n_y))
-
-    def _put_fields_worker(
+        # Rows are encoded and committed in separate pools so that batches of
+        # every partition (row) are committed concurrently as soon as they're built.
+        # Rows are only submitted for building as earlier ones are queued, and queueing
+        # blocks once max_queued_batches are waiting on the write pool, so memory is bounded.
+        queued = threading.BoundedSemaphore(self.max_queued_batches)
+        write_futures = []
+
+        def queue_batches(build: concurrent.futures.Future):
+            for entities in build.result():
+                queued.acquire()
+                fut = self._write_executor.submit(self._commit_batch, entities)
+                fut.add_done_callback(lambda _: queued.release())
+                write_futures.append(fut)
+
+        with concurrent.futures.ThreadPoolExecutor() as build_ex:
+            pending_builds: Deque[concurrent.futures.Future] = collections.deque()
+
+            for y in range(proj.n_y):
+                if len(pending_builds) >= self.max_pending_builds:
+                    queue_batches(pending_builds.popleft())
+                pending_builds.append(build_ex.submit(self._build_batches, proj, fields, y))
+
+            while pending_builds:
+                queue_batches(pending_builds.popleft())
+
+        errors = [fut.exception() for fut in concurrent.futures.wait(write_futures).done if fut.exception() is not None]
+
+        for e in errors:
+            self.logger.error("Exception committing batch: %s", e)
+
+        if errors:
+            raise errors[0]
+
+    def _commit_batch(self, entities: Sequence[dict]):
+        """
+        Inserts (or merges) the given entities, all of which must be in the same partition,
+        in a single batch. Failed batches are retried with backoff.
+        """
+        for attempt in range(self.batch_retries + 1):
+            try:
+                with self._table_service().batch(self.table_name) as batch:
+                    for entity in entities:
+                        # Insert or merge here because if two models share projection, there may already be
+                        # data for the other model at the same (proj,y,valid_time,run_time,x)
+                        batch.insert_or_merge_entity(entity)
+                return
+            except Exception as e:
+                if attempt == self.batch_retries:
+                    raise
+                self.logger.warning("Batch commit failed (%s), retrying", e)
+                time.sleep(0.5 * 2**attempt)
+
+    def _build_batches(
             self,
             proj: Projection,
             fields: Dict[Tuple[int, datetime.datetime, datetime.datetime], List[numpy.array]],
             y: int
-    ):
+    ) -> List[Sequence[dict]]:
+        """
+        Encodes row y of every field into batches of entities (of the same partition)
+        """
         partition = f"{proj.id}-{y}"
         rows: Dict[Tuple[datetime.datetime, datetime.datetime, int], Dict[str, EntityProperty]] = {}
 
@@ -155,35 +248,39 @@ class AzureTableBackend(DataProvider):
 
                 for msg in msgs:
                     # XXX: this only keeps last msg per field breaking ensembles
-                    rows[row_key][f"sf{field_id}"] = EntityProperty(EdmType.BINARY, zlib.compress(msg[y][x:x+self.n_x_per_row].astype(numpy.float32).tobytes()))
-
-        for row_chunk in chunk(rows.items(), 100):
-            with TableService(self.account_name, self.account_key).batch(self.table_name) as batch:
-                for row_key, row in row_chunk:
-                    valid_time, run_time, x = row_key
-                    # Insert or merge here because if two models share projection, there may already be
-                    # data for the other model at the same (proj,y,valid_time,run_time,x)
-                    batch.insert_or_merge_entity({
-                        'PartitionKey': partition,
-                        'RowKey': f"{valid_time.isoformat()},{run_time.isoformat()},{x}",
-                        'XShard': x,
-                        # These 2 are needed for reading (reconstructing a DataPointSet).
-                        # Technically redundant (both are already in row key) but it makes reading a bit cleaner
-                        # and storage overhead is minimal.
-                        'ValidTime': valid_time,
-                        'RunTime': run_time,
-                        **row,
-                    })
+                    rows[row_key][f"sf{field_id}"] = EntityProperty(EdmType.BINARY, encode_shard(msg[y][x:x+self.n_x_per_row], self.shard_encoding))
+
+        entities = []
+        for (valid_time, run_time, x), row in rows.items():
+            entities.append({
+                'PartitionKey': partition,
+                'RowKey': f"{valid_time.isoformat()},{run_time.isoformat()},{x}",
+                'XShard': x,
+                # These 2 are needed for reading (reconstructing a DataPointSet).
+                # Technically redundant (both are already in row key) but it makes reading a bit cleaner
+                # and storage overhead is minimal.
+                'ValidTime': valid_time,
+                'RunTime': run_time,
+                **row,
+            })
+
+        # Batches are limited to 100 entities
+        return list(chunk(entities, 100))
 
     def clean(self, oldest_time: datetime.datetime):
         earliest = oldest_time.replace(microsecond=0)
 
         for proj in Projection.query.all():
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as ex:
-                ex.map(lambda y: self._clean_worker(earliest, proj, y), range(proj.n_y))
+            futures = concurrent.futures.wait([
+                self._write_executor.submit(self._clean_worker, earliest, proj, y)
+                for y in range(proj.n_y)
+            ]).done
+            for fut in futures:
+                if fut.exception() is not None:
+                    self.logger.error("Exception cleaning: %s", fut.exception())
 
     def _clean_worker(self, earliest: datetime.datetime, proj: Projection, y: int):
-        svc = TableService(self.account_name, self.account_key)
+        svc = self._table_service()
         to_delete = []
 
         for row in svc.query_entities(self.table_name, f"PartitionKey eq '{proj.id}-{y}' and RowKey lt '{earliest.isoformat()}'", 'PartitionKey,RowKey'):
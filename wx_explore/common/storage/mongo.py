@@ -1,15 +1,19 @@
-from typing import Dict, Tuple, List, Any
+from typing import Dict, Tuple, List, Any, Optional
 
-import array
+import collections
 import concurrent.futures
 import datetime
 import logging
 import numpy
 import pymongo
+import pymongo.errors
 import pytz
+import re
+import threading
 import zlib
 
 from . import DataProvider
+from .shards import encode_shard, decode_shard
 from wx_explore.common import tracing
 from wx_explore.common.models import (
     Projection,
@@ -18,21 +22,109 @@ from wx_explore.common.models import (
 )
 
 
+# Fields uniquely identifying a document
+KEY_FIELDS = ('proj_id', 'valid_time', 'run_time', 'y', 'x_shard')
+
+DUPLICATE_KEY_ERROR = 11000
+
+
 class MongoBackend(DataProvider):
+    """
+    Stores x shards of each row as documents keyed by (proj_id, valid_time, run_time, y, x_shard).
+    Documents are upserted, setting only the fields being saved, so saving the same data again
+    (e.g. a retried ingest) overwrites it and fields from different files share a document.
+
+    If bucketed, documents go into one collection per valid day (named "{collection}_YYYYMMDD")
+    instead of a single collection. Cleaning then drops whole collections, which is
+    effectively free, rather than deleting expired documents one by one under live traffic.
+    Reads only look at the per-day collections, so turning bucketing on hides everything
+    already in the single collection (until it's re-ingested or expires).
+    """
     logger: logging.Logger
     account_name: str
     account_key: str
     table_name: str
     n_x_per_row: int = 128
+    # Number of threads building and inserting documents in put_fields.
+    # zlib and pymongo's socket I/O both release the GIL.
+    put_parallelism: int = 8
+    # Max number of documents sent in each bulk write
+    insert_batch_size: int = 1000
+    compress_level: int = zlib.Z_DEFAULT_COMPRESSION
 
-    def __init__(self, uri: str, database: str, collection: str):
+    def __init__(self, uri: str, database: str, collection: str, shard_encoding: str = 'zlib', bucketed: bool = False):
+        """
+        :param shard_encoding: How new shards are stored (see shards.encode_shard)
+        :param bucketed: Store documents in per-day collections. Documents in the unbucketed collection are not read.
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.collection = pymongo.MongoClient(uri)[database][collection]
-        self.collection.create_index([
-            ('proj_id', pymongo.ASCENDING),
-            ('valid_time', pymongo.ASCENDING),
-            ('y', pymongo.ASCENDING),
-        ])
+        self.shard_encoding = shard_encoding
+        self.bucketed = bucketed
+        self.client = pymongo.MongoClient(uri)
+        self.database = self.client[database]
+        self.collection_name = collection
+        self.collection = self.database[collection]
+
+        # Names of collections known to have their index
+        self._indexed: set = set()
+        self._indexed_lock = threading.Lock()
+
+        if not self.bucketed:
+            self._ensure_index(self.collection)
+
+    def _ensure_index(self, collection):
+        with self._indexed_lock:
+            if collection.name in self._indexed:
+                return
+
+            try:
+                collection.create_index([(field, pymongo.ASCENDING) for field in KEY_FIELDS], unique=True)
+            except pymongo.errors.OperationFailure as e:
+                if e.code != DUPLICATE_KEY_ERROR:
+                    raise
+                # Written before saves were upserts. Still usable (reads just see the duplicates)
+                # but concurrent upserts of a new document could duplicate it too.
+                self.logger.error("%s has duplicate documents, unable to create unique index", collection.name)
+                collection.create_index([(field, pymongo.ASCENDING) for field in KEY_FIELDS])
+            self._indexed.add(collection.name)
+
+    def _bucket_name(self, valid_time: datetime.datetime) -> str:
+        return f"{self.collection_name}_{valid_time.strftime('%Y%m%d')}"
+
+    def _bucket_time(self, name: str) -> Optional[datetime.datetime]:
+        """
+        Returns the start of the day held by the bucket collection with the given name
+        (or None if it isn't a bucket collection)
+        """
+        m = re.fullmatch(re.escape(self.collection_name) + r'_(\d{8})', name)
+        if m is None:
+            return None
+        return datetime.datetime.strptime(m.group(1), '%Y%m%d')
+
+    def _collection_for(self, valid_time: datetime.datetime):
+        if not self.bucketed:
+            return self.collection
+
+        collection = self.database[self._bucket_name(valid_time)]
+        self._ensure_index(collection)
+        return collection
+
+    def _collections_between(self, start: datetime.datetime, end: datetime.datetime) -> list:
+        """
+        Returns the collections which could hold documents with valid_time in [start, end)
+        """
+        if not self.bucketed:
+            return [self.collection]
+
+        # Querying a collection which doesn't exist (yet) just returns nothing,
+        # so there's no need to look up which ones exist
+        buckets = []
+        day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day < end:
+            buckets.append(self.database[self._bucket_name(day)])
+            day += datetime.timedelta(days=1)
+
+        return buckets
 
     def get_fields(
             self,
@@ -42,42 +134,69 @@ class MongoBackend(DataProvider):
             start: datetime.datetime,
             end: datetime.datetime
     ) -> List[DataPointSet]:
-        x, y = loc
+        return self.get_fields_batch(proj_id, [loc], valid_source_fields, start, end)[loc]
 
-        nearest_row_x = ((x // self.n_x_per_row) * self.n_x_per_row)
-        rel_x = x - nearest_row_x
+    def get_fields_batch(
+            self,
+            proj_id: int,
+            locs: List[Tuple[float, float]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> Dict[Tuple[float, float], List[DataPointSet]]:
+        # Locations in the same (y, x_shard) are stored in the same documents
+        locs_by_shard: Dict[Tuple[int, int], List[Tuple[float, float]]] = collections.defaultdict(list)
+        for loc in set(locs):
+            x, y = loc
+            nearest_row_x = ((x // self.n_x_per_row) * self.n_x_per_row)
+            locs_by_shard[(y, nearest_row_x)].append(loc)
 
-        with tracing.start_span('get_fields lookup'):
-            results = self.collection.find({
-                'proj_id': proj_id,
-                'y': y,
-                'x_shard': nearest_row_x,
-                'valid_time': {
-                    '$gte': start,
-                    '$lt': end,
-                },
-            })
+        query = {
+            'proj_id': proj_id,
+            '$or': [{'y': y, 'x_shard': x_shard} for y, x_shard in locs_by_shard],
+            'valid_time': {
+                '$gte': start,
+                '$lt': end,
+            },
+        }
+
+        with tracing.start_span('get_fields lookup') as span:
+            span.set_attribute("num_shards", len(locs_by_shard))
 
-        data_points = []
+            to_query = self._collections_between(start, end)
+            span.set_attribute("num_collections", len(to_query))
+
+            if len(to_query) == 1:
+                results = to_query[0].find(query)
+            else:
+                # Query all (usually only a few) buckets at once
+                with concurrent.futures.ThreadPoolExecutor(max(1, len(to_query))) as ex:
+                    results = sum(ex.map(lambda collection: list(collection.find(query)), to_query), [])
+
+        data_points: Dict[Tuple[float, float], List[DataPointSet]] = {loc: [] for locs in locs_by_shard.values() for loc in locs}
 
         for item in results:
+            shard_locs = locs_by_shard[(item['y'], item['x_shard'])]
+            # Every requested location in this shard is decoded at once
+            rel_xs = [x - item['x_shard'] for x, _ in shard_locs]
+
             for sf in valid_source_fields:
                 key = f"sf{sf.id}"
                 if key not in item or item[key] is None:
                     continue
 
-                raw = zlib.decompress(item[key])
-                val = array.array("f", raw).tolist()[rel_x]
+                vals = decode_shard(item[key], rel_xs)
 
-                data_point = DataPointSet(
-                    values=[val],
-                    metric_id=sf.metric.id,
-                    valid_time=item['valid_time'].replace(tzinfo=pytz.UTC),
-                    source_field_id=sf.id,
-                    run_time=item['run_time'].replace(tzinfo=pytz.UTC),
-                )
+                for i, loc in enumerate(shard_locs):
+                    data_point = DataPointSet(
+                        values=vals[i:i+1],
+                        metric_id=sf.metric.id,
+                        valid_time=item['valid_time'].replace(tzinfo=pytz.UTC),
+                        source_field_id=sf.id,
+                        run_time=item['run_time'].replace(tzinfo=pytz.UTC),
+                    )
 
-                data_points.append(data_point)
+                    data_points[loc].append(data_point)
 
         return data_points
 
@@ -87,43 +206,109 @@ class MongoBackend(DataProvider):
             fields: Dict[Tuple[int, datetime.datetime, datetime.datetime], List[numpy.array]]
     ):
         # fields is map of (field_id, valid_time, run_time) -> [msg, ...]
-        with concurrent.futures.ThreadPoolExecutor(1) as ex:
-            ex.map(lambda y: self._put_fields_worker(proj, fields, y), range(proj.n_y))
+        n_shards = -(-proj.n_x // self.n_x_per_row)
+        n_times = len(set((valid_time, run_time) for _, valid_time, run_time in fields))
+        # Group enough rows into each task that its insert is about one batch
+        ys_per_task = max(1, self.insert_batch_size // max(1, n_shards * n_times))
+
+        with concurrent.futures.ThreadPoolExecutor(self.put_parallelism) as ex:
+            futures = concurrent.futures.wait([
+                ex.submit(self._put_fields_worker, proj, fields, range(y, min(y + ys_per_task, proj.n_y)))
+                for y in range(0, proj.n_y, ys_per_task)
+            ]).done
+
+        errors = [fut.exception() for fut in futures if fut.exception() is not None]
+        for e in errors:
+            self.logger.error("Exception saving fields: %s", e)
+
+        if errors:
+            raise errors[0]
 
     def _put_fields_worker(
             self,
             proj: Projection,
             fields: Dict[Tuple[int, datetime.datetime, datetime.datetime], List[numpy.array]],
-            y: int
+            ys: range
     ):
-        rows: Dict[Tuple[datetime.datetime, datetime.datetime, int], Dict[str, Any]] = {}
+        rows: Dict[Tuple[datetime.datetime, datetime.datetime, int, int], Dict[str, Any]] = {}
+
+        # Shards are n_x_per_row wide except the last, which gets whatever is left
+        n_full = proj.n_x // self.n_x_per_row
+        split_x = n_full * self.n_x_per_row
 
         with tracing.start_span('put_fields transformations') as span:
             span.set_attribute("num_fields", len(fields))
+            span.set_attribute("num_rows", len(ys))
 
             for (field_id, valid_time, run_time), msgs in fields.items():
-                for x in range(0, proj.n_x, self.n_x_per_row):
-                    row_key = (valid_time, run_time, x)
-
-                    if row_key not in rows:
-                        rows[row_key] = {
-                            'proj_id': proj.id,
-                            'valid_time': valid_time,
-                            'run_time': run_time,
-                            'y': y,
-                            'x_shard': x,
-                        }
-
-                    for msg in msgs:
-                        # XXX: this only keeps last msg per field breaking ensembles
-                        rows[row_key][f"sf{field_id}"] = zlib.compress(msg[y][x:x+self.n_x_per_row].astype(numpy.float32).tobytes())
+                # XXX: this only keeps last msg per field breaking ensembles
+                msg = msgs[-1]
+
+                for y in ys:
+                    row = numpy.ascontiguousarray(numpy.ma.getdata(msg[y]), dtype=numpy.float32)
+                    shards = list(row[:split_x].reshape(n_full, self.n_x_per_row))
+                    if split_x < proj.n_x:
+                        shards.append(row[split_x:])
+
+                    for i, shard in enumerate(shards):
+                        x = i * self.n_x_per_row
+                        row_key = (valid_time, run_time, y, x)
+
+                        if row_key not in rows:
+                            rows[row_key] = {
+                                'proj_id': proj.id,
+                                'valid_time': valid_time,
+                                'run_time': run_time,
+                                'y': y,
+                                'x_shard': x,
+                            }
+
+                        rows[row_key][f"sf{field_id}"] = encode_shard(shard, self.shard_encoding, self.compress_level)
 
         with tracing.start_span('put_fields saving') as span:
-            self.collection.insert_many(rows.values())
+            span.set_attribute("num_docs", len(rows))
+
+            docs_by_collection: Dict[str, List[Dict[str, Any]]] = collections.defaultdict(list)
+            for (valid_time, _, _, _), doc in rows.items():
+                docs_by_collection[self._collection_for(valid_time).name].append(doc)
+
+            for name, docs in docs_by_collection.items():
+                for i in range(0, len(docs), self.insert_batch_size):
+                    self._upsert_docs(self.database[name], docs[i:i+self.insert_batch_size])
+
+    def _upsert_docs(self, collection, docs: List[Dict[str, Any]]):
+        """
+        Saves docs, setting their fields on any existing documents with the same key
+        """
+        ops = [
+            pymongo.UpdateOne({field: doc[field] for field in KEY_FIELDS}, {'$set': doc}, upsert=True)
+            for doc in docs
+        ]
+
+        try:
+            collection.bulk_write(ops, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            failed = e.details['writeErrors']
+            if any(err['code'] != DUPLICATE_KEY_ERROR for err in failed):
+                raise
+
+            # Lost the race to create these documents with a concurrent upsert,
+            # so they now exist and retrying will update them
+            collection.bulk_write([ops[err['index']] for err in failed], ordered=False)
 
     def clean(self, oldest_time: datetime.datetime):
+        if self.bucketed:
+            for name in self.database.list_collection_names():
+                day = self._bucket_time(name)
+                # Only drop days which are entirely expired.
+                # Readers always filter by valid time, so the rest of a partially expired day is harmless.
+                if day is not None and day + datetime.timedelta(days=1) <= oldest_time:
+                    self.logger.info("Dropping expired collection %s", name)
+                    self.database.drop_collection(name)
+            return
+
         for proj in Projection.query.all():
-            self.collection.remove({
+            self.collection.delete_many({
                 'proj_id': proj.id,
                 'valid_time': {
                     '$lt': oldest_time,
@@ -132,3 +317,6 @@ class MongoBackend(DataProvider):
 
     def merge(self):
         pass
+
+    def close(self):
+        self.client.close()
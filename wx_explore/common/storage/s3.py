@@ -1,35 +1,179 @@
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 from functools import partial
 from math import ceil
-from typing import List, Dict, Tuple
+from typing import Callable, List, Dict, Optional, Tuple
 
-import array
+import aiohttp
+import asyncio
 import boto3
 import collections
 import concurrent.futures
 import datetime
 import hashlib
+import itertools
 import logging
 import numpy
 import os
 import random
 import requests
+import requests.adapters
+import threading
+import time
 import urllib.parse
+import zlib
 
 from . import DataProvider
 from wx_explore.common import tracing
+from wx_explore.common.cache import LRUCache
+from wx_explore.common.catalog import catalog
 from wx_explore.common.location import clear_proj_cache
 from wx_explore.common.models import (
     Projection,
     SourceField,
     FileMeta,
     FileBandMeta,
+    MergeJob,
+    MergeProgress,
     DataPointSet,
 )
-from wx_explore.common.utils import chunk
+from wx_explore.common.utils import chunk, run_async
 from wx_explore.web.core import db
 
 
+def plan_stripe_reads(xs, loc_size, max_gap):
+    """
+    Groups the given x offsets in a stripe into runs which can each be fetched with
+    a single range request, only merging neighbors if doing so reads at most max_gap
+    unneeded bytes between them.
+    :return: List of sorted lists of x
+    """
+    runs = []
+
+    for x in sorted(set(xs)):
+        if runs and (x - runs[-1][-1] - 1) * loc_size <= max_gap:
+            runs[-1].append(x)
+        else:
+            runs.append([x])
+
+    return runs
+
+
+def plan_block_reads(xs, block_size):
+    """
+    Groups the given x offsets in a block-compressed stripe into runs whose blocks are
+    consecutive, so each run can be fetched with a single range request.
+    :return: List of sorted lists of x
+    """
+    runs = []
+
+    for x in sorted(set(xs)):
+        if runs and x // block_size - runs[-1][-1] // block_size <= 1:
+            runs[-1].append(x)
+        else:
+            runs.append([x])
+
+    return runs
+
+
+def block_index_size(n_x, block_size):
+    """
+    Size of the block index at the start of a block-compressed stripe:
+    uint32 offsets (relative to the end of the index) of the start of each block, plus the end of the last
+    """
+    return 4 * (ceil(n_x / block_size) + 1)
+
+
+def compress_stripe(stripe: numpy.ndarray, block_size: int, level: int) -> bytes:
+    """
+    Compresses a (n_x, loc_size) uint8 stripe into a block index followed by
+    independently compressed blocks of block_size locations.
+    Each block is byte-shuffled (transposed so each byte of a location's chunk is grouped
+    with the same byte of its neighbors) before compressing, since neighboring values
+    (and especially the exponent bytes of floats) are similar.
+    """
+    blocks = []
+    for start in range(0, stripe.shape[0], block_size):
+        shuffled = stripe[start:start+block_size].T.tobytes()
+        blocks.append(zlib.compress(shuffled, level))
+
+    offsets = numpy.zeros(len(blocks) + 1, dtype=numpy.uint32)
+    offsets[1:] = numpy.cumsum([len(b) for b in blocks])
+
+    return offsets.tobytes() + b''.join(blocks)
+
+
+def decompress_block(data, loc_size: int) -> bytes:
+    """
+    Inverse of the per-block compression in compress_stripe
+    """
+    shuffled = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8)
+    return shuffled.reshape(loc_size, -1).T.tobytes()
+
+
+def decompress_stripe(content, n_x: int, block_size: int, loc_size: int) -> bytes:
+    index_size = block_index_size(n_x, block_size)
+    offsets = numpy.frombuffer(content, dtype=numpy.uint32, count=index_size // 4)
+    content = memoryview(content)[index_size:]
+    return b''.join(decompress_block(content[offsets[i]:offsets[i+1]], loc_size) for i in range(len(offsets) - 1))
+
+
+def _missing_as_nan(vals: numpy.ndarray) -> numpy.ndarray:
+    """
+    Returns the values with masked (i.e. missing) points replaced by NaN
+    """
+    return numpy.ma.filled(numpy.ma.asarray(vals, dtype=numpy.float64), numpy.nan)
+
+
+def choose_encoding(msgs: List[numpy.ndarray]) -> Tuple[Optional[str], Optional[float], Optional[float]]:
+    """
+    Picks the smallest encoding (see FileBandMeta.ENCODINGS) for a band with the given values.
+    Categorical fields (all integers in 0-254, e.g. rain/snow flags) are stored exactly as uint8.
+    Everything else is quantized to int16 over the band's range, which is at least as precise
+    as GRIB's own packing for any field packed with 16 or fewer bits per value.
+    Missing (masked or non-finite) points are ignored here and stored as missing.
+    :return: (encoding, scale, add_offset)
+    """
+    vals = [_missing_as_nan(msg) for msg in msgs]
+    finite = [numpy.isfinite(v) for v in vals]
+
+    if not any(f.any() for f in finite):
+        # Nothing but missing values
+        return ('i2', 1.0, 0.0)
+
+    present = [v[f] for v, f in zip(vals, finite) if f.any()]
+    lo = min(v.min() for v in present)
+    hi = max(v.max() for v in present)
+
+    if lo >= 0 and hi < FileBandMeta.U1_MISSING and all(numpy.array_equal(v, numpy.round(v)) for v in present):
+        return ('u1', None, None)
+
+    # Raw values span [-32767, 32767], with -32768 reserved for missing values
+    scale = float(hi - lo) / 65534 or 1.0
+    return ('i2', scale, float(lo) + 32767 * scale)
+
+
+def encode_values(vals: numpy.ndarray, encoding: Optional[str], scale: Optional[float], add_offset: Optional[float]) -> numpy.ndarray:
+    """
+    Converts values to the dtype of the given encoding (inverse of FileBandMeta.decode)
+    """
+    if encoding is None:
+        # Same as assigning a masked array into a float32 array: the data under any mask is stored
+        return numpy.ma.getdata(vals).astype(numpy.float32)
+
+    vals = _missing_as_nan(vals)
+    finite = numpy.isfinite(vals)
+
+    if encoding == 'u1':
+        return numpy.where(finite, vals, FileBandMeta.U1_MISSING).astype(numpy.uint8)
+
+    raw = numpy.clip(numpy.round((vals - add_offset) / scale), -32767, 32767)
+    return numpy.where(finite, raw, FileBandMeta.I2_MISSING).astype(numpy.int16)
+
+
+# Metadata of a file being merged, copied from its FileMeta for the threads building merged stripes
+MergeSource = collections.namedtuple('MergeSource', ['file_name', 'loc_size', 'block_size'])
+
+
 class S3Backend(DataProvider):
     logger: logging.Logger
     access_key: str
@@ -37,13 +181,70 @@ class S3Backend(DataProvider):
     region: str
     bucket: str
     endpiont: str
-
-    def __init__(self, access_key, secret_access_key, region='us-east-1', bucket=None, endpoint=None):
+    # Maximum number of unneeded bytes that will be read between two locations in a stripe
+    # to fetch them with one request instead of two.
+    # Past this, the transfer time of the gap outweighs the extra request's latency.
+    max_read_gap: int = 256 * 1024
+
+    # Max number of concurrent (synchronous) requests, and so pooled connections, to S3.
+    # Requests beyond this wait for a connection rather than opening one which the pool would discard.
+    pool_size: int = 32
+    # Max number of concurrent reads on the shared event loop
+    max_concurrent_reads: int = 128
+    # Max seconds all reads of one get_fields_batch (including retries and waiting on other reads) may take
+    read_batch_timeout: float = 120
+    # Max bytes of stripes built and waiting to be uploaded during put_fields
+    put_memory_budget: int = 256 * 1024 * 1024
+    max_tries: int = 3
+    # Base and max of the (jittered) exponential backoff between tries, in seconds
+    backoff_base: float = 0.25
+    backoff_max: float = 8.0
+    # zlib level used for block-compressed stripes
+    compress_level: int = 3
+    # Number of block indexes (one per stripe) cached.
+    # Files are immutable so these never need to be invalidated.
+    block_index_cache_size: int = 100000
+    # Max number of stripes (rows) merged at once, across all projections
+    merge_parallelism: int = 16
+    # Max number of source stripes loaded at once for each stripe being merged.
+    # All loads share the pool_size connections.
+    merge_read_parallelism: int = 8
+    # Max (approximate) bytes used by stripes being merged at once
+    merge_memory_budget: int = 1024 * 1024 * 1024
+    # Number of passes over a merge's stripes (the first plus retries of failed ones) per merge run
+    merge_stripe_tries: int = 2
+    # Number of merge runs a job can take before it's abandoned
+    merge_job_max_tries: int = 5
+    # Number of finished stripes recorded per commit
+    merge_progress_interval: int = 50
+
+    def __init__(
+            self,
+            access_key,
+            secret_access_key,
+            region='us-east-1',
+            bucket=None,
+            endpoint=None,
+            connect_timeout=5,
+            read_timeout=30,
+            block_size=0,
+            quantize=False
+    ):
+        """
+        :param block_size: If non-zero, new files are written in the block-compressed format
+                           with this many locations per block
+        :param quantize: Store values in the smallest encoding that (nearly) preserves them
+                         (see choose_encoding) instead of float32
+        """
         self.access_key = access_key
         self.secret_access_key = secret_access_key
         self.region = region
         self.bucket = bucket
         self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        self.block_size = block_size
+        self.quantize = quantize
+        self._block_indexes = LRUCache(self.block_index_cache_size)
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.auth = AWSRequestsAuth(
@@ -56,6 +257,30 @@ class S3Backend(DataProvider):
             aws_service='s3',
         )
 
+        # Keep connections alive across requests (and threads) so each range read
+        # or stripe upload doesn't need its own TCP+TLS handshake.
+        # Retries are handled in _s3_request so we can back off between them.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Held for each request so that however many threads are making them (e.g. merge_parallelism
+        # stripes each loading merge_read_parallelism files), only pool_size connections are used
+        self._request_slots = threading.BoundedSemaphore(self.pool_size)
+
+        # Used for reads, see _get_aio_session
+        self._aio_session = None
+        self._aio_session_loop = None
+
+    def close(self):
+        self.session.close()
+
+        # The session is only usable on the loop that created it, so close it there
+        if self._aio_session is not None and self._aio_session_loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._aio_session.close(), self._aio_session_loop).result(timeout=5)
+        self._aio_session = None
+        self._aio_session_loop = None
+
     def _get_s3_bucket(self, session=boto3):
         return session.resource(
             's3',
@@ -76,39 +301,163 @@ class S3Backend(DataProvider):
         # Manual endpoint, assume path style
         return f"{self.endpoint}/{self.bucket}/{path}"
 
-    def _s3_get(self, path, **kwargs):
-        for _ in range(3):
+    def _backoff(self, i):
+        # "Full jitter" backoff so parallel workers don't retry in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**i))
+
+    def _s3_request(self, method, path, **kwargs):
+        for i in range(self.max_tries):
+            if i > 0:
+                time.sleep(self._backoff(i))
+
             try:
-                resp = requests.get(self._s3_path(path), auth=self.auth, **kwargs)
+                with self._request_slots:
+                    resp = self.session.request(method, self._s3_path(path), auth=self.auth, timeout=self.timeout, **kwargs)
                 if resp.ok:
                     return resp
             except Exception as e:
-                self.logger.warning("Exception getting from S3: %s", e)
+                self.logger.warning("Exception during S3 %s of %s: %s", method, path, e)
                 continue
-            self.logger.warning("Unexpected response getting from S3: %s", resp)
+            self.logger.warning("Unexpected response during S3 %s of %s: %s", method, path, resp)
 
-        raise Exception(f"Unable to get {path} from S3 - maximum retries exceeded")
+        raise Exception(f"Unable to {method} {path} on S3 - maximum retries exceeded")
+
+    def _s3_get(self, path, **kwargs):
+        return self._s3_request('GET', path, **kwargs)
 
     def _s3_put(self, path, data, **kwargs):
-        for _ in range(3):
+        return self._s3_request('PUT', path, data=data, **kwargs)
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Returns the number of requests made to S3 and the number of connections
+        that had to be opened for them.
+        The difference is how many handshakes were saved by reusing connections.
+        """
+        n_requests = 0
+        n_connections = 0
+        pools = self.session.get_adapter(self._s3_path('')).poolmanager.pools
+        for key in pools.keys():
             try:
-                resp = requests.put(self._s3_path(path), data=data, auth=self.auth, **kwargs)
-                if resp.ok:
-                    return resp
-            except Exception as e:
-                self.logger.warning("Exception uploading to S3: %s", e)
+                pool = pools[key]
+            except KeyError:
+                # Evicted between listing and lookup
                 continue
-            self.logger.warning("Unexpected response uploading to S3: %s", resp)
+            n_requests += pool.num_requests
+            n_connections += pool.num_connections
+
+        return {
+            'requests': n_requests,
+            'connections': n_connections,
+            'reused': max(n_requests - n_connections, 0),
+        }
+
+    async def _get_aio_session(self) -> aiohttp.ClientSession:
+        # Sessions are bound to the loop they were created on, which changes after a fork
+        loop = asyncio.get_running_loop()
+        if self._aio_session is None or self._aio_session_loop is not loop:
+            self._aio_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrent_reads),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+            )
+            self._aio_session_loop = loop
+        return self._aio_session
+
+    def _sign_headers(self, method, path, headers):
+        req = requests.Request(method, self._s3_path(path), headers=headers).prepare()
+        return dict(self.auth(req).headers)
+
+    async def _s3_get_async(self, path, headers=None) -> Tuple[int, bytes]:
+        """
+        Async version of _s3_get for use on the shared event loop.
+        :return: (status code, content)
+        """
+        session = await self._get_aio_session()
+
+        for i in range(self.max_tries):
+            if i > 0:
+                await asyncio.sleep(self._backoff(i))
+
+            try:
+                # Re-sign each try since the signature is only valid for a short time
+                async with session.get(self._s3_path(path), headers=self._sign_headers('GET', path, headers or {})) as resp:
+                    if resp.ok:
+                        return resp.status, await resp.read()
+                    self.logger.warning("Unexpected response during S3 GET of %s: %s", path, resp.status)
+            except Exception as e:
+                self.logger.warning("Exception during S3 GET of %s: %s", path, e)
+
+        raise Exception(f"Unable to GET {path} on S3 - maximum retries exceeded")
+
+    async def load_stripe_chunks(self, fm, y, xs):
+        """
+        Loads the chunks for each of xs from the stripe at row y of the given file,
+        using a single range request covering all of them.
+        Callers should use plan_stripe_reads to decide which xs to load together.
+        :return: Dict of x -> chunk
+        """
+        start = min(xs) * fm.loc_size
+        end = (max(xs) + 1) * fm.loc_size
+
+        status, content = await self._s3_get_async(f"{y}/{fm.file_name}", headers={'Range': f'bytes={start}-{end-1}'})
+
+        # Some S3-compatible stores ignore the range and return the whole stripe
+        if status != 206:
+            start = 0
 
-        raise Exception(f"Unable to upload {path} to S3 - maximum retries exceeded")
+        # memoryview so each chunk is a view into the response instead of a copy
+        content = memoryview(content)
 
-    def load_file_chunk(self, fm, coords):
-        x, y = coords
+        return {x: content[x * fm.loc_size - start:(x + 1) * fm.loc_size - start] for x in xs}
 
-        start = x * fm.loc_size
-        end = (x + 1) * fm.loc_size
+    async def _load_block_index(self, fm, n_x, y) -> numpy.ndarray:
+        key = (fm.file_name, y)
+        offsets = self._block_indexes.get(key)
 
-        return self._s3_get(f"{y}/{fm.file_name}", headers={'Range': f'bytes={start}-{end-1}'}).content
+        if offsets is None:
+            index_size = block_index_size(n_x, fm.block_size)
+            _, content = await self._s3_get_async(f"{y}/{fm.file_name}", headers={'Range': f'bytes=0-{index_size-1}'})
+            # Copy since the store may have ignored the range and returned the whole stripe
+            offsets = numpy.frombuffer(content, dtype=numpy.uint32, count=index_size // 4).copy()
+            self._block_indexes.set(key, offsets)
+
+        return offsets
+
+    async def load_block_chunks(self, fm, n_x, y, xs):
+        """
+        Block-compressed version of load_stripe_chunks. Loads (and decompresses) the blocks
+        containing each of xs with a single range request, after loading the stripe's block index if it isn't cached.
+        Callers should use plan_block_reads to decide which xs to load together.
+        :return: Dict of x -> chunk
+        """
+        offsets = await self._load_block_index(fm, n_x, y)
+        index_size = 4 * len(offsets)
+
+        first_block = min(xs) // fm.block_size
+        last_block = max(xs) // fm.block_size
+
+        start = index_size + int(offsets[first_block])
+        end = index_size + int(offsets[last_block + 1])
+
+        status, content = await self._s3_get_async(f"{y}/{fm.file_name}", headers={'Range': f'bytes={start}-{end-1}'})
+
+        if status != 206:
+            content = content[start:end]
+
+        content = memoryview(content)
+
+        chunks = {}
+        for block in range(first_block, last_block + 1):
+            block_xs = [x for x in xs if x // fm.block_size == block]
+            if not block_xs:
+                continue
+
+            data = memoryview(decompress_block(content[offsets[block] - offsets[first_block]:offsets[block + 1] - offsets[first_block]], fm.loc_size))
+            block_start = block * fm.block_size
+            for x in block_xs:
+                chunks[x] = data[(x - block_start) * fm.loc_size:(x - block_start + 1) * fm.loc_size]
+
+        return chunks
 
     def get_fields(
             self,
@@ -118,9 +467,29 @@ class S3Backend(DataProvider):
             start: datetime.datetime,
             end: datetime.datetime
     ) -> List[DataPointSet]:
+        return self.get_fields_batch(proj_id, [loc], valid_source_fields, start, end)[loc]
+
+    def get_fields_batch(
+            self,
+            proj_id: int,
+            locs: List[Tuple[float, float]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> Dict[Tuple[float, float], List[DataPointSet]]:
+        return self.prepare_fields_batch(proj_id, locs, valid_source_fields, start, end)()
+
+    def prepare_fields_batch(
+            self,
+            proj_id: int,
+            locs: List[Tuple[float, float]],
+            valid_source_fields: List[SourceField],
+            start: datetime.datetime,
+            end: datetime.datetime
+    ) -> Callable[[], Dict[Tuple[float, float], List[DataPointSet]]]:
         with tracing.start_span("load file band metas") as span:
             fbms: List[FileBandMeta] = FileBandMeta.query.filter(
-                FileBandMeta.source_field.has(id=proj_id),
+                FileBandMeta.source_field.has(projection_id=proj_id),
                 FileBandMeta.source_field_id.in_([sf.id for sf in valid_source_fields]),
                 FileBandMeta.valid_time >= start,
                 FileBandMeta.valid_time < end,
@@ -129,35 +498,111 @@ class S3Backend(DataProvider):
         # Gather all files we need data from
         file_metas = set(fbm.file_meta for fbm in fbms)
 
+        # Needed to find the block index of block-compressed files
+        n_x = catalog.get_projection(proj_id).n_x
+
+        return lambda: self._load_fields_batch(fbms, n_x, locs)
+
+    def _load_fields_batch(
+            self,
+            fbms: List[FileBandMeta],
+            n_x: int,
+            locs: List[Tuple[float, float]]
+    ) -> Dict[Tuple[float, float], List[DataPointSet]]:
+        """
+        Reads the given (already looked up) bands at each of locs.
+        Only the (eagerly loaded) attributes of fbms are used, so this doesn't touch the DB.
+        """
+        file_metas = set(fbm.file_meta for fbm in fbms)
+
+        # All locations on the same row are in the same stripe, so nearby ones can share a request
+        xs_by_y = collections.defaultdict(set)
+        for x, y in locs:
+            xs_by_y[y].add(x)
+
+        reads = [
+            (fm, y, xs)
+            for fm in file_metas
+            for y, stripe_xs in xs_by_y.items()
+            for xs in (
+                plan_block_reads(stripe_xs, fm.block_size) if fm.block_size
+                else plan_stripe_reads(stripe_xs, fm.loc_size, self.max_read_gap)
+            )
+        ]
+
+        async def load_all():
+            return await asyncio.gather(*(
+                self.load_block_chunks(fm, n_x, y, xs) if fm.block_size else self.load_stripe_chunks(fm, y, xs)
+                for fm, y, xs in reads
+            ))
+
+        # (file name, x, y) -> chunk
         file_contents = {}
 
-        # Read them in (in parallel)
-        # TODO: use asyncio here instead once everything else is ported?
+        # Read them in (concurrently, on the shared event loop)
         with tracing.start_span("load file chunks") as span:
             span.set_attribute("num_files", len(file_metas))
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = {executor.submit(self.load_file_chunk, fm, loc): fm for fm in file_metas}
-                for future in concurrent.futures.as_completed(futures):
-                    fm = futures[future]
-                    file_contents[fm.file_name] = future.result()
+            span.set_attribute("num_reads", len(reads))
+            for (fm, y, _), chunks in zip(reads, run_async(load_all(), timeout=self.read_batch_timeout)):
+                for x, content in chunks.items():
+                    file_contents[(fm.file_name, x, y)] = content
 
         # filebandmeta -> values
-        data_points = []
-        for fbm in fbms:
-            raw = file_contents[fbm.file_name][fbm.offset:fbm.offset+(4*fbm.vals_per_loc)]
-            data_values: List[float] = array.array("f", raw).tolist()
-            data_point = DataPointSet(
-                values=data_values,
-                metric_id=fbm.source_field.metric.id,
-                valid_time=fbm.valid_time,
-                source_field_id=fbm.source_field_id,
-                run_time=fbm.run_time,
-            )
+        data_points = {}
+        for loc in set(locs):
+            x, y = loc
+            data_points[loc] = []
+
+            for fbm in fbms:
+                # View directly into the loaded chunk (no copy for float32 bands)
+                data_values = fbm.decode(numpy.frombuffer(
+                    file_contents[(fbm.file_name, x, y)],
+                    dtype=fbm.dtype,
+                    count=fbm.vals_per_loc,
+                    offset=fbm.offset,
+                ))
+
+                if fbm.encoding is not None:
+                    # Drop missing (NaN) values so they never reach stats or JSON responses,
+                    # and the whole point if nothing is left (e.g. outside the model's domain)
+                    data_values = data_values[~numpy.isnan(data_values)]
+                    if len(data_values) == 0:
+                        continue
+
+                data_point = DataPointSet(
+                    values=data_values,
+                    metric_id=fbm.source_field.metric_id,
+                    valid_time=fbm.valid_time,
+                    source_field_id=fbm.source_field_id,
+                    run_time=fbm.run_time,
+                )
 
-            data_points.append(data_point)
+                data_points[loc].append(data_point)
 
         return data_points
 
+    @staticmethod
+    def _build_stripe(vals: List[tuple], y: int, loc_size: int) -> numpy.ndarray:
+        """
+        Builds row y of a file, interleaving the (encoded) values of every band for each x.
+        :param vals: List of (msg, encoding, scale, add_offset, offset in each location's chunk)
+        :return: (n_x, loc_size) uint8 array
+        """
+        n_x = len(vals[0][0][y])
+        stripe = numpy.empty((n_x, loc_size), dtype=numpy.uint8)
+        for msg, encoding, scale, add_offset, offset in vals:
+            encoded = encode_values(msg[y], encoding, scale, add_offset)
+            stripe[:, offset:offset + encoded.itemsize] = encoded.reshape(n_x, 1).view(numpy.uint8)
+        return stripe
+
+    def _encode_stripe(self, stripe: numpy.ndarray) -> bytes:
+        """
+        Serializes a (n_x, loc_size) uint8 stripe in the format new files are written in
+        """
+        if self.block_size:
+            return compress_stripe(stripe, self.block_size, self.compress_level)
+        return stripe.tobytes()
+
     def put_fields(
             self,
             proj: Projection,
@@ -172,44 +617,71 @@ class S3Backend(DataProvider):
         fm = FileMeta(
             file_name=s3_file_name,
             projection_id=proj.id,
+            block_size=self.block_size or None,
         )
         db.session.add(fm)
 
         offset = 0
         for i, ((field_id, valid_time, run_time), msgs) in enumerate(fields.items()):
-            metas.append(FileBandMeta(
+            encoding, scale, add_offset = choose_encoding(msgs) if self.quantize else (None, None, None)
+
+            meta = FileBandMeta(
                 file_name=s3_file_name,
                 source_field_id=field_id,
                 valid_time=valid_time,
                 run_time=run_time,
                 offset=offset,
                 vals_per_loc=len(msgs),
-            ))
+                encoding=encoding,
+                scale=scale,
+                add_offset=add_offset,
+            )
+            metas.append(meta)
 
             for msg in msgs:
-                vals.append(msg.astype(numpy.float32))
-                offset += 4  # sizeof(float32)
+                # Keep a reference to the source array instead of copying it.
+                # Stripes are built from these one row at a time below.
+                vals.append((msg, encoding, scale, add_offset, offset))
+                offset += meta.dtype.itemsize
 
-        combined = numpy.stack(vals, axis=-1)
         fm.loc_size = offset
 
+        # Bound the number of stripes built but not yet uploaded so memory use
+        # scales with the stripe size instead of the entire grid
+        stripe_size = proj.n_x * fm.loc_size
+        max_in_flight = max(1, min(2 * self.pool_size, self.put_memory_budget // stripe_size))
+        in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        def upload_stripe(y, data):
+            try:
+                self._s3_put(f"{y}/{s3_file_name}", data)
+            finally:
+                in_flight.release()
+
         self.logger.info("Creating file group %s", s3_file_name)
 
-        with concurrent.futures.ThreadPoolExecutor(32) as executor:
-            futures = concurrent.futures.wait([
-                executor.submit(self._s3_put, f"{y}/{s3_file_name}", vals.tobytes())
-                for y, vals in enumerate(combined)
-            ])
+        with concurrent.futures.ThreadPoolExecutor(self.pool_size) as executor:
+            futures = []
+            for y in range(proj.n_y):
+                # Blocks while too many stripes are waiting on upload
+                in_flight.acquire()
+                futures.append(executor.submit(upload_stripe, y, self._encode_stripe(self._build_stripe(vals, y, fm.loc_size))))
+
+            futures = concurrent.futures.wait(futures)
             for fut in futures.done:
                 if fut.exception() is not None:
                     self.logger.warning("Exception creating files: %s", fut.exception())
 
+        self.logger.info("S3 connection stats: %s", self.connection_stats())
+
         db.session.add_all(metas)
         db.session.commit()
 
     def clean(self, _oldest_time: datetime.datetime):
         files = FileMeta.query.filter(
             FileMeta.file_name.notin_(FileBandMeta.query.with_entities(FileBandMeta.file_name)),
+            # Merged files don't have bands until the merge finishes
+            FileMeta.file_name.notin_(MergeJob.query.with_entities(MergeJob.file_name)),
 
             FileMeta.ctime <= datetime.datetime.utcnow() - datetime.timedelta(hours=1),  # make sure we don't delete files being populated right now
             # XXX: I don't think the above ctime check is actually necessary since all filemeta and filebandmeta
@@ -250,26 +722,31 @@ class S3Backend(DataProvider):
     ###
 
     def _load_stripe(self, used_idxs, y, n_x, f):
-        stripe_req = self._s3_get(f"{y}/{f.file_name}")
+        content = self._s3_get(f"{y}/{f.file_name}").content
+
+        if f.block_size:
+            content = decompress_stripe(content, n_x, f.block_size, f.loc_size)
 
-        if len(stripe_req.content) != n_x * f.loc_size:
-            raise ValueError(f"Invalid file size in {y}/{f.file_name}. Expected {n_x*f.loc_size}, got {len(stripe_req.content)}")
+        if len(content) != n_x * f.loc_size:
+            raise ValueError(f"Invalid file size in {y}/{f.file_name}. Expected {n_x*f.loc_size}, got {len(content)}")
 
-        datas = numpy.frombuffer(stripe_req.content, dtype=numpy.float32).reshape((n_x, f.loc_size//4))
+        # Bands can have different encodings, so everything is moved around as bytes
+        datas = numpy.frombuffer(content, dtype=numpy.uint8).reshape((n_x, f.loc_size))
         return datas[:, used_idxs[f]]
 
     def _create_merged_stripe(self, files, used_idxs, s3_file_name, n_x, y, trace_span):
         with tracing.start_span('parallel stripe loading', parent=trace_span):
-            with concurrent.futures.ThreadPoolExecutor(10) as executor:
+            with concurrent.futures.ThreadPoolExecutor(self.merge_read_parallelism) as executor:
                 contents = list(executor.map(partial(self._load_stripe, used_idxs, y, n_x), files))
 
         with tracing.start_span('merged stripe save', parent=trace_span):
-            d = numpy.concatenate(contents, axis=1).tobytes()
+            d = self._encode_stripe(numpy.concatenate(contents, axis=1))
             self._s3_put(f"{y}/{s3_file_name}", d)
 
-    def merge(self):
+    def _plan_merges(self, exclude) -> List[MergeJob]:
         """
-        Merge all (small) files into larger files to reduce the number of S3 requests each query needs to do.
+        Groups the files of each projection into batches to merge, creating a job for each.
+        :param exclude: Names of files which are already part of another job
         """
         all_files = FileMeta.query.filter(
             FileMeta.file_name.in_(FileBandMeta.query.filter(FileBandMeta.valid_time > datetime.datetime.utcnow()).with_entities(FileBandMeta.file_name)),
@@ -279,7 +756,10 @@ class S3Backend(DataProvider):
 
         proj_files = collections.defaultdict(list)
         for f in all_files:
-            proj_files[f.projection].append(f)
+            if f.file_name not in exclude:
+                proj_files[f.projection].append(f)
+
+        jobs = []
 
         # Pull from the projection with the most backlog first
         for proj, proj_files in sorted(proj_files.items(), key=lambda pair: len(pair[1]), reverse=True):
@@ -296,13 +776,8 @@ class S3Backend(DataProvider):
                 # This next part is all about figuring out what items are still used in
                 # each file so that the merge process can effectively garbage collect
                 # unused data.
-
-                # Dict of FileMeta -> list of float32 item indexes still used by some band
-                used_idxs = collections.defaultdict(list)
-
+                bands = []
                 offset = 0
-                # Dict of FileBandMeta -> offset
-                new_offsets = {}
 
                 for f in files:
                     for band in f.bands:
@@ -311,59 +786,201 @@ class S3Backend(DataProvider):
                         if band.valid_time < datetime.datetime.utcnow():
                             continue
 
-                        new_offsets[band] = offset
-                        offset += 4 * band.vals_per_loc
-
-                        start_idx = band.offset // 4
-                        used_idxs[f].extend(range(start_idx, start_idx + band.vals_per_loc))
+                        bands.append([f.file_name, band.offset, band.size, offset])
+                        offset += band.size
 
                 s3_file_name = hashlib.md5(('-'.join(f.file_name for f in files)).encode('utf-8')).hexdigest()
 
+                # Left over from an abandoned merge of the same files, and not cleaned yet
+                if FileMeta.query.get(s3_file_name) is not None:
+                    self.logger.info("Skipping merge into %s until the previous attempt is cleaned", s3_file_name)
+                    continue
+
                 merged_meta = FileMeta(
                     file_name=s3_file_name,
-                    projection_id=proj.id,
+                    projection=proj,
                     loc_size=offset,
+                    block_size=self.block_size or None,
                 )
-                db.session.add(merged_meta)
-
-                self.logger.info("Merging %s into %s", ','.join(f.file_name for f in files), s3_file_name)
-
-                n_y, n_x = proj.shape()
-
-                # If we fail to create any merged stripe, don't commit the changes to
-                # band offset/file name, but _do_ commit the FileMeta to the DB.
-                # This way the normal cleaning process will remove any orphaned bands.
-                commit_merged = True
-
-                # max workers = 10 to limit mem utilization
-                # Approximate worst case, we'll have
-                # (5 sources * 70 runs * 2000 units wide * 20 metrics/unit * 4 bytes per metric) per row
-                # or ~50MB/row in memory.
-                # 10 rows keeps us well under 1GB which is what this should be provisioned for.
-                with tracing.start_span('parallel stripe creation') as span:
-                    span.set_attribute("s3_file_name", s3_file_name)
-                    span.set_attribute("num_files", len(files))
-
-                    with concurrent.futures.ThreadPoolExecutor(10) as executor:
-                        futures = concurrent.futures.wait([
-                            executor.submit(self._create_merged_stripe, files, used_idxs, s3_file_name, n_x, y, span)
-                            for y in range(n_y)
-                        ])
-                        for fut in futures.done:
+                job = MergeJob(file_meta=merged_meta, bands=bands, tries=0)
+                db.session.add(job)
+                jobs.append(job)
+
+                self.logger.info("Planned merge of %s into %s", ','.join(f.file_name for f in files), s3_file_name)
+
+        return jobs
+
+    def _prepare_merge_job(self, job: MergeJob) -> Optional[Tuple[Dict[MergeSource, List[int]], int, List[int]]]:
+        """
+        Loads what's needed to upload the stripes of job which haven't been uploaded yet.
+        :return: (used_idxs, n_x, ys left), or None if the job can't be finished
+        """
+        # Sources must be concatenated in the same order the plan was made in
+        source_names = list(dict.fromkeys(file_name for file_name, _, _, _ in job.bands))
+        metas = {f.file_name: f for f in FileMeta.query.filter(FileMeta.file_name.in_(source_names))}
+
+        # The cleaner removed a source file (all of its bands expired) in the meantime
+        if len(metas) != len(source_names):
+            return None
+
+        # Plain copies of the metadata the stripe workers need, since ORM
+        # objects are expired (and reloaded) as progress is committed
+        sources = {
+            file_name: MergeSource(file_name, metas[file_name].loc_size, metas[file_name].block_size)
+            for file_name in source_names
+        }
+
+        # Dict of MergeSource -> list of byte indexes (in each location's chunk) moving to the merged file
+        used_idxs: Dict[MergeSource, List[int]] = collections.defaultdict(list)
+        for file_name, offset, size, _ in job.bands:
+            used_idxs[sources[file_name]].extend(range(offset, offset + size))
+
+        done = set(y for (y,) in MergeProgress.query.filter_by(file_name=job.file_name).with_entities(MergeProgress.y))
+        n_y, n_x = job.file_meta.projection.shape()
+
+        return (used_idxs, n_x, [y for y in range(n_y) if y not in done])
+
+    def _finish_merge_job(self, job: MergeJob):
+        """
+        Points every band of a finished job at the merged file
+        """
+        source_names = set(file_name for file_name, _, _, _ in job.bands)
+        bands = {
+            (band.file_name, band.offset): band
+            for band in FileBandMeta.query.filter(FileBandMeta.file_name.in_(source_names))
+        }
+
+        for file_name, offset, _, new_offset in job.bands:
+            band = bands.get((file_name, offset))
+            # Cleaned while merging
+            if band is None:
+                continue
+            band.file_name = job.file_name
+            band.offset = new_offset
+
+        self.logger.info("Finished merge into %s", job.file_name)
+        self._remove_merge_job(job)
+
+    @staticmethod
+    def _remove_merge_job(job: MergeJob):
+        # If the job didn't finish, the merged file has no bands so the cleaner removes it (and its uploaded stripes)
+        MergeProgress.query.filter_by(file_name=job.file_name).delete()
+        db.session.delete(job)
+
+    def merge(self):
+        """
+        Merge all (small) files into larger files to reduce the number of S3 requests each query needs to do.
+
+        Merges are planned into jobs whose uploaded stripes are recorded as they finish.
+        Stripes which fail (or are interrupted by a crash) are picked back up by the next merge
+        without redoing the rest. Stripes of all jobs are created concurrently, bounded by
+        merge_parallelism and merge_memory_budget.
+        """
+        jobs = MergeJob.query.all()
+        if jobs:
+            self.logger.info("Resuming %d merges", len(jobs))
+
+        jobs += self._plan_merges(set(file_name for job in jobs for file_name, _, _, _ in job.bands))
+
+        # Dict of merged file name -> (job, used_idxs, n_x, ys left)
+        runnable = {}
+        for job in jobs:
+            job.tries += 1
+
+            if job.tries > self.merge_job_max_tries:
+                self.logger.warning("Giving up on merge into %s after %d tries", job.file_name, job.tries - 1)
+                self._remove_merge_job(job)
+                continue
+
+            prepared = self._prepare_merge_job(job)
+            if prepared is None:
+                self.logger.warning("Source of merge into %s was removed, giving up", job.file_name)
+                self._remove_merge_job(job)
+                continue
+
+            if not prepared[2]:
+                self._finish_merge_job(job)
+                continue
+
+            runnable[job.file_name] = (job, *prepared)
+
+        db.session.commit()
+
+        if runnable:
+            self._run_merge_jobs(runnable)
+
+        clear_proj_cache()
+
+    def _run_merge_jobs(self, jobs):
+        # Stripes of each projection are interleaved so several projections are merged at once.
+        # Each stripe is (merged file name, y, approximate peak memory used creating it).
+        stripes_by_proj = collections.defaultdict(list)
+        for file_name, (job, used_idxs, n_x, ys) in jobs.items():
+            # Source stripes, plus the merged stripe before and after encoding
+            stripe_bytes = n_x * (sum(source.loc_size for source in used_idxs) + 2 * job.file_meta.loc_size)
+            stripes_by_proj[job.file_meta.projection_id].extend((file_name, y, stripe_bytes) for y in ys)
+
+        pending = collections.deque(
+            stripe
+            for stripes in itertools.zip_longest(*stripes_by_proj.values())
+            for stripe in stripes
+            if stripe is not None
+        )
+        # Dict of merged file name -> number of stripes left
+        remaining = {file_name: len(ys) for file_name, (_, _, _, ys) in jobs.items()}
+
+        with tracing.start_span('parallel stripe creation') as span:
+            span.set_attribute("num_jobs", len(jobs))
+            span.set_attribute("num_stripes", len(pending))
+
+            with concurrent.futures.ThreadPoolExecutor(self.merge_parallelism) as executor:
+                for attempt in range(self.merge_stripe_tries):
+                    failed = []
+                    in_flight = {}
+                    in_flight_bytes = 0
+                    n_unsaved = 0
+
+                    while pending or in_flight:
+                        # Always allow one stripe, even if it alone is over budget
+                        while pending and len(in_flight) < self.merge_parallelism and (
+                                not in_flight or in_flight_bytes + pending[0][2] <= self.merge_memory_budget):
+                            file_name, y, stripe_bytes = pending.popleft()
+                            _, used_idxs, n_x, _ = jobs[file_name]
+                            fut = executor.submit(self._create_merged_stripe, list(used_idxs), used_idxs, file_name, n_x, y, span)
+                            in_flight[fut] = (file_name, y, stripe_bytes)
+                            in_flight_bytes += stripe_bytes
+
+                        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                        for fut in done:
+                            file_name, y, stripe_bytes = in_flight.pop(fut)
+                            in_flight_bytes -= stripe_bytes
+
                             if fut.exception() is not None:
-                                self.logger.error("Exception merging: %s", fut.exception())
-                                commit_merged = False
+                                self.logger.error("Exception merging row %d of %s: %s", y, file_name, fut.exception())
+                                failed.append((file_name, y, stripe_bytes))
+                                continue
+
+                            db.session.add(MergeProgress(file_name=file_name, y=y))
+                            n_unsaved += 1
+
+                            remaining[file_name] -= 1
+                            if remaining[file_name] == 0:
+                                self._finish_merge_job(jobs[file_name][0])
+                                db.session.commit()
+                                n_unsaved = 0
 
-                    span.set_attribute("commit", commit_merged)
+                        if n_unsaved >= self.merge_progress_interval:
+                            db.session.commit()
+                            n_unsaved = 0
 
-                if commit_merged:
-                    for band, offset in new_offsets.items():
-                        band.offset = offset
-                        band.file_name = merged_meta.file_name
+                    db.session.commit()
 
-                    self.logger.info("Updated file band meta")
+                    if not failed:
+                        break
 
-                db.session.commit()
+                    self.logger.warning("Retrying %d failed stripes", len(failed))
+                    pending.extend(failed)
 
-            # We know we won't need this projection again, so clear it
-            clear_proj_cache()
+            # Jobs with stripes left are resumed by the next merge
+            span.set_attribute("num_unfinished", sum(1 for n in remaining.values() if n > 0))
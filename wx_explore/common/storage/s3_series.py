@@ -0,0 +1,179 @@
+from functools import partial
+from typing import Dict, List
+
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import numpy
+
+from .s3 import S3Backend
+from wx_explore.common import tracing
+from wx_explore.common.location import clear_proj_cache
+from wx_explore.common.models import (
+    FileMeta,
+    FileBandMeta,
+)
+from wx_explore.web.core import db
+
+
+class S3SeriesBackend(S3Backend):
+    """
+    S3 backend which keeps data in a time-major layout: after compaction, each
+    (projection, source field) has a single series file where every location's
+    chunk holds that field's values sorted by (valid time, run time).
+
+    Ingest works exactly like S3Backend (one small file per ingested GRIB), and `merge`
+    folds those into the series files. A point query then needs one range read per
+    source field per projection (plus one per file ingested since the last merge)
+    instead of one per ingested file.
+    """
+    # Bands whose valid time is older than this are left alone during compaction,
+    # since the cleaner is about to remove them.
+    min_band_age: datetime.timedelta = datetime.timedelta(hours=20)
+    # Number of rows compacted at once. Each needs every live value in the row in memory.
+    merge_parallelism: int = 10
+
+    def _create_series_stripes(self, files, used_idxs, columns_by_file_name, n_x, y, trace_span):
+        with tracing.start_span('parallel stripe loading', parent=trace_span):
+            with concurrent.futures.ThreadPoolExecutor(self.merge_read_parallelism) as executor:
+                contents = list(executor.map(partial(self._load_stripe, used_idxs, y, n_x), files))
+
+        with tracing.start_span('series stripe save', parent=trace_span):
+            merged = numpy.concatenate(contents, axis=1)
+            for file_name, columns in columns_by_file_name.items():
+                self._s3_put(f"{y}/{file_name}", self._encode_stripe(numpy.ascontiguousarray(merged[:, columns])))
+
+    def _compact_projection(self, proj, files: List[FileMeta]):
+        oldest_time = datetime.datetime.utcnow() - self.min_band_age
+
+        # Dict of source field id -> bands
+        field_bands: Dict[int, List[FileBandMeta]] = collections.defaultdict(list)
+        for f in files:
+            for band in f.bands:
+                if band.valid_time >= oldest_time:
+                    field_bands[band.source_field_id].append(band)
+
+        # Dict of source field id -> bands, for each series file which needs to be (re)built
+        to_compact = {
+            source_field_id: sorted(bands, key=lambda band: (band.valid_time, band.run_time))
+            for source_field_id, bands in field_bands.items()
+            # Skip fields which are already compacted with nothing new to fold in
+            if not (len(set(band.file_name for band in bands)) == 1 and bands[0].file_name.startswith('series-'))
+        }
+
+        if not to_compact:
+            self.logger.info("Projection %d is already compacted", proj.id)
+            return
+
+        # Dict of source field id -> series file name
+        series_names = {
+            source_field_id: 'series-' + hashlib.md5('-'.join(
+                [str(proj.id), str(source_field_id)] + sorted(set(band.file_name for band in bands))
+            ).encode('utf-8')).hexdigest()
+            for source_field_id, bands in to_compact.items()
+        }
+
+        for source_field_id, file_name in series_names.items():
+            # Left over from a failed compaction of the same files, and not cleaned yet
+            if FileMeta.query.get(file_name) is not None:
+                self.logger.info("Skipping series %s until the previous attempt is cleaned", file_name)
+                del to_compact[source_field_id]
+
+        if not to_compact:
+            return
+
+        # Dict of FileMeta -> list of byte indexes (in each location's chunk) which are moving to a series file
+        used_idxs: Dict[FileMeta, List[int]] = collections.defaultdict(list)
+        for bands in to_compact.values():
+            for band in bands:
+                used_idxs[band.file_meta].extend(range(band.offset, band.offset + band.size))
+
+        # Only files which have bands moving need to be read.
+        # Dict of (FileMeta, byte index) -> column in the concatenation of their loaded stripes
+        files = [f for f in files if f in used_idxs]
+        columns: Dict[tuple, int] = {}
+        for f in files:
+            for idx in used_idxs[f]:
+                columns[(f, idx)] = len(columns)
+
+        # Dict of series file name -> columns of the concatenated stripes that go into it (in order)
+        columns_by_file_name: Dict[str, List[int]] = {}
+        # Dict of FileBandMeta -> (new file name, new offset)
+        new_locations: Dict[FileBandMeta, tuple] = {}
+        series_metas = []
+
+        for source_field_id, bands in to_compact.items():
+            file_name = series_names[source_field_id]
+
+            series_columns = []
+            offset = 0
+            for band in bands:
+                new_locations[band] = (file_name, offset)
+                offset += band.size
+
+                series_columns.extend(columns[(band.file_meta, idx)] for idx in range(band.offset, band.offset + band.size))
+
+            columns_by_file_name[file_name] = series_columns
+            series_metas.append(FileMeta(
+                file_name=file_name,
+                projection_id=proj.id,
+                loc_size=offset,
+                block_size=self.block_size or None,
+            ))
+
+        self.logger.info("Compacting %d files into %d series files for projection %d", len(files), len(series_metas), proj.id)
+
+        db.session.add_all(series_metas)
+
+        n_y, n_x = proj.shape()
+
+        # As with S3Backend.merge, if any stripe fails, don't move the bands
+        # but do commit the FileMetas so the cleaner removes the partial files.
+        commit_merged = True
+
+        with tracing.start_span('parallel series stripe creation') as span:
+            span.set_attribute("projection_id", proj.id)
+            span.set_attribute("num_files", len(files))
+            span.set_attribute("num_series", len(series_metas))
+
+            with concurrent.futures.ThreadPoolExecutor(self.merge_parallelism) as executor:
+                futures = concurrent.futures.wait([
+                    executor.submit(self._create_series_stripes, files, used_idxs, columns_by_file_name, n_x, y, span)
+                    for y in range(n_y)
+                ])
+                for fut in futures.done:
+                    if fut.exception() is not None:
+                        self.logger.error("Exception compacting: %s", fut.exception())
+                        commit_merged = False
+
+            span.set_attribute("commit", commit_merged)
+
+        if commit_merged:
+            for band, (file_name, offset) in new_locations.items():
+                band.file_name = file_name
+                band.offset = offset
+
+            self.logger.info("Updated file band meta")
+
+        db.session.commit()
+
+    def merge(self):
+        """
+        Compacts all files of each projection into one time-major series file per source field.
+        """
+        all_files = FileMeta.query.filter(
+            FileMeta.file_name.in_(FileBandMeta.query.with_entities(FileBandMeta.file_name)),
+        ).order_by(
+            FileMeta.ctime.asc(),
+        ).all()
+
+        proj_files = collections.defaultdict(list)
+        for f in all_files:
+            proj_files[f.projection].append(f)
+
+        for proj, files in proj_files.items():
+            self._compact_projection(proj, files)
+
+            # We know we won't need this projection again, so clear it
+            clear_proj_cache()
@@ -0,0 +1,43 @@
+from typing import List
+
+import numpy
+import zlib
+
+# Shard encodings which can be written
+SHARD_ENCODINGS = ('zlib', 'raw')
+
+# Prefix of uncompressed ('raw') shards.
+# zlib streams always start with a CMF byte whose low nibble is 8 (deflate),
+# so this can never be mistaken for one and shards are self-describing.
+RAW_SHARD_HEADER = b'\x00'
+
+
+def encode_shard(vals: numpy.ndarray, encoding: str = 'zlib', level: int = zlib.Z_DEFAULT_COMPRESSION) -> bytes:
+    """
+    Encodes the (float32) values of one x shard, as stored by the Mongo and Azure Table backends.
+    'zlib' shards are smaller, while any single value of a 'raw' shard can be read without inflating it.
+    """
+    vals = numpy.ascontiguousarray(numpy.ma.getdata(vals), dtype=numpy.float32)
+
+    if encoding == 'raw':
+        return RAW_SHARD_HEADER + vals.tobytes()
+    elif encoding == 'zlib':
+        return zlib.compress(vals, level)
+
+    raise ValueError(f"Unknown shard encoding {encoding}")
+
+
+def decode_shard(data: bytes, rel_xs: List[int]) -> numpy.ndarray:
+    """
+    Returns the values at the given offsets into an encoded shard.
+    Raw shards are read in place, without decoding any other values.
+    """
+    if data[:1] == RAW_SHARD_HEADER:
+        if len(rel_xs) == 1:
+            # View directly into the shard (no copy)
+            return numpy.frombuffer(data, dtype=numpy.float32, count=1, offset=len(RAW_SHARD_HEADER) + 4 * rel_xs[0])
+        vals = numpy.frombuffer(data, dtype=numpy.float32, offset=len(RAW_SHARD_HEADER))
+    else:
+        vals = numpy.frombuffer(zlib.decompress(data), dtype=numpy.float32)
+
+    return vals[rel_xs]
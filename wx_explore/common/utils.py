@@ -1,12 +1,17 @@
 from collections.abc import Iterable
 from itertools import islice
-from typing import Iterable as IterableT, Tuple, Any
+from typing import Iterable as IterableT, Tuple, Any, Awaitable, Optional, TypeVar
+import asyncio
 import collections
+import concurrent.futures
 import datetime
 import functools
 import logging
 import math
+import os
 import requests
+import requests.adapters
+import threading
 import time
 
 
@@ -23,19 +28,48 @@ def datetime2unix(dt: datetime.datetime) -> int:
     return int(dt.timestamp())
 
 
-def get_url(url, headers=None, retries=3):
+HTTP_POOL_SIZE = 16
+
+_http_session: Optional[requests.Session] = None
+_http_session_pid: Optional[int] = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Returns a process-wide requests session whose connection pool is shared by all threads.
+    The pool blocks once HTTP_POOL_SIZE connections to a host are in use, which bounds
+    how hard we hit upstream servers no matter how many threads are fetching.
+    """
+    global _http_session, _http_session_pid
+
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            _http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+            _http_session.mount('http://', adapter)
+            _http_session.mount('https://', adapter)
+            _http_session_pid = os.getpid()
+
+        return _http_session
+
+
+def get_url(url, headers=None, retries=3, session=None):
     if headers is None:
         headers = {}
 
+    if session is None:
+        session = requests
+
     for i in range(retries):
         try:
-            r = requests.get(url, headers=headers, timeout=30)
+            r = session.get(url, headers=headers, timeout=30)
             if i == 0 and r.status_code == 404:
                 # NOMADS seems to have bad load balancing and will occasionally return 404
                 # for a file that has been previously fetched.
                 # Retry once
                 time.sleep(1)
-                r = requests.get(url, headers=headers)
+                r = session.get(url, headers=headers)
             break
         except KeyboardInterrupt:
             raise
@@ -57,6 +91,47 @@ def url_exists(url):
     return 200 <= r.status_code < 400
 
 
+T = TypeVar('T')
+
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_event_loop_pid: Optional[int] = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the process-wide event loop used for async I/O, starting it on a
+    background thread if needed.
+    The loop is re-created after a fork since the thread running it doesn't survive the fork.
+    """
+    global _event_loop, _event_loop_pid
+
+    with _event_loop_lock:
+        if _event_loop is None or _event_loop_pid != os.getpid():
+            _event_loop = asyncio.new_event_loop()
+            _event_loop_pid = os.getpid()
+            threading.Thread(target=_event_loop.run_forever, name='async-io', daemon=True).start()
+
+        return _event_loop
+
+
+def run_async(coro: Awaitable[T], timeout: Optional[float] = None) -> T:
+    """
+    Runs the given coroutine on the shared event loop, blocking until it completes.
+    This lets synchronous (e.g. flask) code fan out lots of I/O on a single loop
+    without creating threads per request.
+    Must not be called from the loop's own thread (or its default executor, which the loop
+    needs for e.g. DNS resolution) since that can deadlock.
+    :param timeout: Max seconds to wait. On timeout the coroutine is cancelled and TimeoutError is raised.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
 def chunk(it, size):
     it = iter(it)
     return iter(lambda: tuple(islice(it, size)), ())
@@ -2,7 +2,9 @@ from typing import TYPE_CHECKING
 import binascii
 import logging
 import numpy
+import threading
 
+from wx_explore.common.location import load_projection_grid, save_projection_grid
 from wx_explore.common.models import Projection
 from wx_explore.common.task_queue import pq
 from wx_explore.web.core import db
@@ -12,6 +14,10 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# Serializes looking up and creating projections, since files are decoded concurrently
+# (see pipeline.py) and two threads seeing the same new projection would both create it
+_projection_lock = threading.Lock()
+
 
 def get_queue():
     return pq['ingest']
@@ -27,24 +33,28 @@ def get_or_create_projection(msg):
 
     ll_hash = binascii.crc32(numpy.round([lats, lons], 8).tobytes())
 
-    projection = Projection.query.filter_by(
-        params=msg.projparams,
-        ll_hash=ll_hash,
-    ).first()
-
-    if projection is None:
-        logger.info("Creating new projection with params %s", msg.projparams)
-
-        projection = Projection(
+    with _projection_lock:
+        projection = Projection.query.filter_by(
             params=msg.projparams,
-            n_x=msg.values.shape[1],
-            n_y=msg.values.shape[0],
             ll_hash=ll_hash,
-            lats=lats.tolist(),
-            lons=lons.tolist(),
-        )
-        db.session.add(projection)
-        db.session.commit()
+        ).first()
+
+        if projection is None:
+            logger.info("Creating new projection with params %s", msg.projparams)
+
+            projection = Projection(
+                params=msg.projparams,
+                n_x=msg.values.shape[1],
+                n_y=msg.values.shape[0],
+                ll_hash=ll_hash,
+                lats=lats.tolist(),
+                lons=lons.tolist(),
+            )
+            db.session.add(projection)
+            db.session.commit()
+
+        if load_projection_grid(projection) is None:
+            save_projection_grid(projection, lats, lons)
 
     return projection
 
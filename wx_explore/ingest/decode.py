@@ -0,0 +1,229 @@
+from typing import List, Optional, Tuple
+
+import concurrent.futures
+import concurrent.futures.process
+import logging
+import multiprocessing
+import numpy
+import os
+import pygrib
+import tempfile
+import threading
+
+from wx_explore.common.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Messages are decoded as doubles by ecCodes
+VALUE_DTYPE = numpy.float64
+# Decoded values are passed back from decode processes through a (tmpfs backed) file here
+SHM_DIR = '/dev/shm'
+
+_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def get_decode_pool() -> Optional[concurrent.futures.ProcessPoolExecutor]:
+    """
+    Returns the process-wide pool used to decode GRIB messages,
+    or None if decoding should happen in-process.
+    """
+    global _pool, _pool_pid
+
+    if Config.INGEST_DECODE_PROCESSES <= 1:
+        return None
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # spawn rather than fork since the ingest worker is multithreaded.
+            # Children re-import the main module, so it (and this module) must not import the app/DB.
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                Config.INGEST_DECODE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def _reset_pool(pool: concurrent.futures.ProcessPoolExecutor):
+    """
+    Drops the given (broken) pool so the next decode creates a new one.
+    """
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+            _pool_pid = None
+
+    pool.shutdown(wait=False)
+
+
+def _iter_messages(grib, msg_nums: List[int]):
+    """
+    Yields the given messages of an open GRIB, which must be in ascending order.
+    grib.message(n) rewinds and skips through the file from the start every time,
+    so this instead only ever moves forward from the last message read.
+    """
+    pos = 0
+    grib.rewind()
+
+    for msg_num in msg_nums:
+        if msg_num - 1 > pos:
+            grib.seek(msg_num - 1 - pos, 1)
+        msg = grib.readline()
+        pos = msg_num
+
+        if msg is None or msg.messagenumber != msg_num:
+            raise ValueError(f"Unable to read message {msg_num}")
+
+        yield msg
+
+
+def _decode_local(file_path: str, messages: List[Tuple[int, int]]) -> List[numpy.ndarray]:
+    """
+    Decodes the given messages in this process.
+    """
+    by_position = sorted(range(len(messages)), key=lambda i: messages[i][0])
+    results = [None] * len(messages)
+
+    grib = pygrib.open(file_path)
+    try:
+        for i, msg in zip(by_position, _iter_messages(grib, [messages[i][0] for i in by_position])):
+            results[i] = msg.values
+    finally:
+        grib.close()
+
+    return results
+
+
+def _create_segment(size: int) -> Optional[str]:
+    """
+    Creates a file of the given size in SHM_DIR to decode into, with all of its space allocated up front.
+    Running out of space in a tmpfs while writing into a mapping of it kills the writer with SIGBUS,
+    whereas this fails cleanly.
+    :return: Path to the file, or None if it doesn't fit
+    """
+    if not os.path.isdir(SHM_DIR):
+        return None
+
+    fd, path = tempfile.mkstemp(prefix='wx_decode_', dir=SHM_DIR)
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        os.unlink(path)
+        return None
+    finally:
+        os.close(fd)
+
+    return path
+
+
+def _decode_into(file_path: str, segment_path: str, tasks: List[Tuple[int, int, int, int]]) -> List[Tuple[Tuple[int, ...], Optional[float]]]:
+    """
+    Decodes the given messages of the GRIB at file_path into the file segment_path (see _create_segment).
+    :param tasks: List of (message number, value offset, mask offset, number of values), in ascending message number
+    :return: List of (shape, fill value (or None if the values aren't masked)) for each message
+    """
+    buf = numpy.memmap(segment_path, dtype=numpy.uint8, mode='r+')
+    grib = pygrib.open(file_path)
+
+    try:
+        results = []
+
+        for (msg_num, vals_offset, mask_offset, size), msg in zip(tasks, _iter_messages(grib, [t[0] for t in tasks])):
+            vals = msg.values
+
+            if vals.size != size:
+                raise ValueError(f"Message {msg_num} has {vals.size} values, expected {size}")
+
+            out = numpy.ndarray(size, dtype=VALUE_DTYPE, buffer=buf, offset=vals_offset)
+            out[:] = numpy.ma.getdata(vals).reshape(-1)
+
+            fill_value = None
+            if numpy.ma.isMaskedArray(vals):
+                out_mask = numpy.ndarray(size, dtype=numpy.bool_, buffer=buf, offset=mask_offset)
+                out_mask[:] = numpy.ma.getmaskarray(vals).reshape(-1)
+                fill_value = vals.fill_value
+
+            results.append((vals.shape, fill_value))
+
+        return results
+    finally:
+        grib.close()
+        del buf
+
+
+def decode_messages(file_path: str, messages: List[Tuple[int, int]]) -> List[numpy.ndarray]:
+    """
+    Decodes the values of the given messages of the GRIB at file_path, spreading
+    the work over all cores.
+
+    Decoded values are passed back through a file in SHM_DIR (/dev/shm), and the returned
+    arrays are views directly into it (the file is unlinked, and its memory freed, once they're
+    all gone). This needs 9 bytes per value decoded: a GFS file is several GB, far more than
+    docker's default 64MB /dev/shm, so containers running the ingest worker need a larger
+    `shm_size`. If a file's values don't fit, it's decoded in-process instead.
+    :param messages: List of (message number, number of values (i.e. numberOfDataPoints))
+    :return: List of values for each message, identical to what msg.values would return
+    """
+    pool = get_decode_pool()
+
+    if pool is None or len(messages) < 2:
+        return _decode_local(file_path, messages)
+
+    # Layout is all values (as VALUE_DTYPE), followed by all masks (1 byte per value)
+    itemsize = numpy.dtype(VALUE_DTYPE).itemsize
+    total_values = sum(size for _, size in messages)
+
+    tasks = []
+    vals_offset = 0
+    mask_offset = total_values * itemsize
+    for msg_num, size in messages:
+        tasks.append((msg_num, vals_offset, mask_offset, size))
+        vals_offset += size * itemsize
+        mask_offset += size
+
+    segment_path = _create_segment(max(1, total_values * (itemsize + 1)))
+    if segment_path is None:
+        logger.warning("Not enough space in %s to decode %d values, decoding in-process", SHM_DIR, total_values)
+        return _decode_local(file_path, messages)
+
+    try:
+        # Split the messages into contiguous runs (by position in the file) so each worker
+        # reads its part of the file front to back (see _iter_messages)
+        by_position = sorted(range(len(tasks)), key=lambda i: tasks[i][0])
+        n_chunks = min(len(tasks), Config.INGEST_DECODE_PROCESSES)
+        chunk_size = -(-len(tasks) // n_chunks)
+        chunks = [by_position[i:i+chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+        futures = [pool.submit(_decode_into, file_path, segment_path, [tasks[i] for i in c]) for c in chunks]
+
+        shapes = [None] * len(tasks)
+        try:
+            for c, future in zip(chunks, futures):
+                for i, shape in zip(c, future.result()):
+                    shapes[i] = shape
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (e.g. was OOM killed). The pool can't be used again.
+            _reset_pool(pool)
+            raise
+
+        # Mapped before unlinking, so the memory stays around for as long as any of the results do
+        buf = numpy.memmap(segment_path, dtype=numpy.uint8, mode='r+')
+    finally:
+        os.unlink(segment_path)
+
+    results = []
+    for (_, vals_offset, mask_offset, size), (shape, fill_value) in zip(tasks, shapes):
+        vals = numpy.ndarray(size, dtype=VALUE_DTYPE, buffer=buf, offset=vals_offset).reshape(shape)
+
+        if fill_value is not None:
+            mask = numpy.ndarray(size, dtype=numpy.bool_, buffer=buf, offset=mask_offset).reshape(shape)
+            vals = numpy.ma.array(vals, mask=mask, fill_value=fill_value, copy=False)
+
+        results.append(vals)
+
+    return results
@@ -0,0 +1,165 @@
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import logging
+import numpy
+
+from wx_explore.analysis.transformations import (
+    apparent_temperature,
+    cartesian_to_polar,
+    dewpoint,
+    relative_humidity,
+)
+from wx_explore.common.models import Metric, SourceField
+
+logger = logging.getLogger(__name__)
+
+
+class Derivation(object):
+    """
+    A set of metrics computed from other metrics at ingest time.
+
+    The kernel is called once per file with one array per input, each
+    with shape (n_times, n_y, n_x), and returns a tuple of one array of the same shape per output.
+    Inputs can be outputs of derivations earlier in the registry.
+    """
+    name: str
+    inputs: List[Metric]
+    outputs: List[Metric]
+    kernel: Callable[..., Tuple[numpy.ndarray, ...]]
+    # Selectors used to find inputs which don't have their own (e.g. intermediate metrics), by metric id
+    selectors: Dict[int, dict]
+
+    def __init__(self, name, inputs, outputs, kernel, selectors=None):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.kernel = kernel
+        self.selectors = selectors or {}
+
+    def applies_to(self, fields_by_metric: Dict[int, SourceField]) -> bool:
+        """
+        Returns if the source with the given fields has all of this derivation's inputs and outputs
+        """
+        return all(m.id in fields_by_metric for m in self.inputs + self.outputs)
+
+    def input_selectors(self, field: SourceField) -> Optional[dict]:
+        return field.selectors or self.selectors.get(field.metric_id)
+
+    def __repr__(self):
+        return f"<Derivation name='{self.name}'>"
+
+
+_derivations: Optional[List[Derivation]] = None
+
+
+def get_derivations() -> List[Derivation]:
+    """
+    Returns the registry of all derivations, in the order they should be run
+    """
+    # Lazily created since importing metrics requires the DB
+    global _derivations
+
+    if _derivations is None:
+        from wx_explore.common import metrics
+
+        _derivations = [
+            Derivation(
+                name='10m wind speed and direction',
+                inputs=[metrics.wind_u, metrics.wind_v],
+                outputs=[metrics.wind_speed, metrics.wind_direction],
+                kernel=cartesian_to_polar,
+                selectors={
+                    metrics.wind_u.id: {'name': '10 metre U wind component', 'stepType': 'instant'},
+                    metrics.wind_v.id: {'name': '10 metre V wind component', 'stepType': 'instant'},
+                },
+            ),
+            Derivation(
+                name='2m relative humidity',
+                inputs=[metrics.humidity, metrics.temp, metrics.pressure],
+                outputs=[metrics.relative_humidity],
+                kernel=relative_humidity,
+            ),
+            Derivation(
+                name='2m dewpoint',
+                inputs=[metrics.humidity, metrics.pressure],
+                outputs=[metrics.dewpoint],
+                kernel=dewpoint,
+            ),
+            Derivation(
+                name='2m apparent temperature',
+                inputs=[metrics.humidity, metrics.temp, metrics.pressure, metrics.wind_speed],
+                outputs=[metrics.apparent_temp],
+                kernel=apparent_temperature,
+            ),
+        ]
+
+    return _derivations
+
+
+def get_input_selectors(derivations: List[Derivation], fields_by_metric: Dict[int, SourceField]) -> Dict[int, dict]:
+    """
+    Returns the selectors to use for each metric that is an input to any of the given derivations
+    :return: Map of metric id to selectors
+    """
+    input_selectors = {}
+    derived_ids = {m.id for derivation in derivations for m in derivation.outputs}
+
+    for derivation in derivations:
+        for metric in derivation.inputs:
+            # Comes from another derivation instead of the GRIB
+            if metric.id in derived_ids:
+                continue
+
+            selectors = derivation.input_selectors(fields_by_metric[metric.id])
+            if selectors is None:
+                logger.warning("No selectors for %s (input to %s)", metric, derivation)
+                continue
+            input_selectors[metric.id] = selectors
+
+    return input_selectors
+
+
+def _stack(arrs):
+    if any(numpy.ma.isMaskedArray(a) for a in arrs):
+        return numpy.ma.stack(arrs)
+    return numpy.stack(arrs)
+
+
+def run_derivations(
+        derivations: List[Derivation],
+        fields_by_metric: Dict[int, SourceField],
+        inputs: Dict[int, Dict[tuple, Tuple[numpy.ndarray, int]]],
+) -> Iterator[Tuple[SourceField, tuple, numpy.ndarray, int]]:
+    """
+    Computes all derivations from already decoded input values.
+    :param inputs: Map of metric id to map of (valid_time, run_time) -> (values, message number).
+                   Outputs are added to this so later derivations can use them.
+    :return: Iterator of (output field, (valid_time, run_time), values, message number of one of the inputs)
+    """
+    for derivation in derivations:
+        if not all(m.id in inputs for m in derivation.inputs):
+            logger.warning("Missing inputs for %s", derivation)
+            continue
+
+        # Only times which have every input can be derived
+        times = sorted(set.intersection(*(set(inputs[m.id]) for m in derivation.inputs)))
+        if not times:
+            logger.warning("No inputs with matching times for %s", derivation)
+            continue
+
+        logger.info("Deriving %s for %d times", derivation.name, len(times))
+
+        results = derivation.kernel(*(
+            _stack([inputs[m.id][t][0] for t in times])
+            for m in derivation.inputs
+        ))
+
+        # Any input works for the projection, valid/analysis dates, etc.
+        first_input = inputs[derivation.inputs[0].id]
+
+        for metric, vals in zip(derivation.outputs, results):
+            field = fields_by_metric[metric.id]
+            outputs = inputs.setdefault(metric.id, {})
+            for i, t in enumerate(times):
+                outputs[t] = (vals[i], first_input[t][1])
+                yield (field, t, vals[i], first_input[t][1])
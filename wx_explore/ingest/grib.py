@@ -1,19 +1,25 @@
 import collections
+import concurrent.futures
 import datetime
 import logging
 import pygrib
 
 from wx_explore.common import tracing, storage
-from wx_explore.common.models import (
-    Metric,
-    SourceField,
-)
-from wx_explore.common.utils import get_url
-from wx_explore.ingest.common import get_or_create_projection, get_source_module
+from wx_explore.common.cache import bump_data_version
+from wx_explore.common.models import SourceField
+from wx_explore.common.utils import get_http_session, get_url, HTTP_POOL_SIZE
+from wx_explore.ingest.common import get_or_create_projection
+from wx_explore.ingest.decode import decode_messages
+from wx_explore.ingest.derived import get_derivations, get_input_selectors, run_derivations
+from wx_explore.ingest.range_cache import range_cache
 from wx_explore.web.core import db
 
 logger = logging.getLogger(__name__)
 
+# Ranges less than this many bytes apart are fetched in one request, discarding the gap
+MAX_RANGE_GAP = 64 * 1024
+MAX_CONCURRENT_RANGES = HTTP_POOL_SIZE
+
 
 def get_grib_ranges(idxs, source_fields):
     """
@@ -48,33 +54,86 @@ def get_grib_ranges(idxs, source_fields):
     return offsets
 
 
+def merge_grib_ranges(offsets, max_gap=MAX_RANGE_GAP):
+    """
+    Merges consecutive ranges which are adjacent or within max_gap bytes of each other
+    so they can be fetched in a single request.
+    :param offsets: List of (start, length), in file order (as returned by get_grib_ranges)
+    :return: List of (start, length, [(start, length), ...]) of each merged range and the original ranges it covers
+    """
+    merged = []
+
+    for start, length in offsets:
+        if merged:
+            m_start, m_length, parts = merged[-1]
+            if m_start <= start <= m_start + m_length + max_gap:
+                merged[-1] = (m_start, max(m_length, start + length - m_start), parts + [(start, length)])
+                continue
+
+        merged.append((start, length, [(start, length)]))
+
+    return merged
+
+
+def get_grib_range(grib_url, start, length):
+    """
+    Fetches length bytes from start of the GRIB at grib_url.
+    :return: Tuple of (offset of the returned data in the file, data)
+    """
+    data = range_cache.get(grib_url, start, length)
+    if data is not None:
+        return (start, data)
+
+    r = get_url(grib_url, headers={
+        "Range": f"bytes={start}-{start + length - 1}"
+    }, session=get_http_session())
+
+    # Some servers ignore the range and return the whole file
+    if r.status_code != 206:
+        return (0, r.content)
+
+    range_cache.put(grib_url, start, length, r.content)
+
+    return (start, r.content)
+
+
 def reduce_grib(grib_url, idx_url, source_fields, out_f):
     """
     Downloads the appropriate chunks (based on desired fields described by source_fields)
     of the GRIB at grib_url (using idx_url to quickly seek around) and writes the chunks
     to out_f.
 
+    Chunks are fetched concurrently but written in their original order.
+
     It is assumed that the caller has checked that the URLs exist before this function is called.
+    :return: Number of chunks written
     """
-    idxs = get_url(idx_url).text
-    offsets = get_grib_ranges(idxs, source_fields)
+    idxs = get_url(idx_url, session=get_http_session()).text
+    merged = merge_grib_ranges(get_grib_ranges(idxs, source_fields))
 
-    for offset, length in offsets:
-        start = offset
-        end = offset + length - 1
+    n_written = 0
 
-        try:
-            grib_data = get_url(grib_url, headers={
-                "Range": f"bytes={start}-{end}"
-            }).content
-        except Exception as e:
-            logger.exception("Unable to fetch grib data. Continuing anyways...")
-            continue
+    with concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENT_RANGES) as executor:
+        futures = [executor.submit(get_grib_range, grib_url, start, length) for start, length, _ in merged]
+
+        for future, (_, _, parts) in zip(futures, merged):
+            try:
+                data_start, grib_data = future.result()
+            except Exception as e:
+                logger.exception("Unable to fetch grib data. Continuing anyways...")
+                continue
 
-        out_f.write(grib_data)
+            # Only write the requested ranges, skipping any gaps fetched along with them
+            for start, length in parts:
+                out_f.write(grib_data[start - data_start:start - data_start + length])
+                n_written += 1
 
     out_f.flush()
 
+    logger.info("GRIB range cache stats: %s", range_cache.stats())
+
+    return n_written
+
 
 def get_end_valid_time(msg):
     """
@@ -100,12 +159,22 @@ def get_end_valid_time(msg):
     return valid_date
 
 
-def ingest_grib_file(file_path, source):
+def update_field_projection(field, msg):
     """
-    Ingests a given GRIB file into the backend.
+    Points field at the projection of msg, creating the projection if needed
+    """
+    if field.projection is None or field.projection.params != msg.projparams:
+        projection = get_or_create_projection(msg)
+        field.projection_id = projection.id
+        db.session.commit()
+
+
+def decode_grib_file(file_path, source):
+    """
+    Decodes all fields (including derived fields) from the given GRIB file.
     :param file_path: Path to the GRIB file
     :param source: Source object which denotes which source this data is from
-    :return: None
+    :return: Map of projection to map of {(field_id, valid_time, run_time) -> [values, ...]}
     """
     logger.info("Processing GRIB file '%s'", file_path)
 
@@ -115,35 +184,85 @@ def ingest_grib_file(file_path, source):
     # Map of projection to map of {(field_id, valid_time, run_time) -> [msg, ...]}
     data_by_projection = collections.defaultdict(lambda: collections.defaultdict(list))
 
-    for field in SourceField.query.filter(SourceField.source_id == source.id, SourceField.metric.has(Metric.intermediate == False)).all():
+    fields = SourceField.query.filter(SourceField.source_id == source.id).all()
+    fields_by_metric = {field.metric_id: field for field in fields}
+
+    derivations = [d for d in get_derivations() if d.applies_to(fields_by_metric)]
+    # Inputs to derivations are decoded along with everything else so they're only decoded once
+    input_selectors = get_input_selectors(derivations, fields_by_metric)
+
+    # (field, projection, (valid_time, run_time), message number, number of values) of each message to decode
+    to_decode = []
+
+    for field in fields:
+        if field.metric_id in input_selectors:
+            selectors = input_selectors[field.metric_id]
+        elif field.metric.intermediate or field.selectors is None:
+            continue
+        else:
+            selectors = field.selectors
+
         try:
-            msgs = grib.select(**field.selectors)
+            msgs = grib.select(**selectors)
         except ValueError:
-            if field.selectors.get('shortName') not in ('wind', 'wdir'):
-                logger.warning("Could not find message(s) in grib matching selectors %s", field.selectors)
+            if selectors.get('shortName') not in ('wind', 'wdir'):
+                logger.warning("Could not find message(s) in grib matching selectors %s", selectors)
             continue
 
         for msg in msgs:
             with tracing.start_span('parse message') as span:
                 span.set_attribute('message', str(msg))
 
-                if field.projection is None or field.projection.params != msg.projparams:
-                    projection = get_or_create_projection(msg)
-                    field.projection_id = projection.id
-                    db.session.commit()
+                # Intermediate fields aren't saved, so they don't need a projection
+                if not field.metric.intermediate:
+                    update_field_projection(field, msg)
 
                 valid_date = get_end_valid_time(msg)
-                data_by_projection[field.projection][(field.id, valid_date, msg.analDate)].append(msg.values)
+                to_decode.append((field, field.projection, (valid_date, msg.analDate), msg.messagenumber, msg.numberOfDataPoints))
+
+    with tracing.start_span('decode messages'):
+        logger.info("Decoding %d messages", len(to_decode))
+        values = decode_messages(file_path, [(msg_num, size) for _, _, _, msg_num, size in to_decode])
+
+    # Map of metric id to {(valid_time, run_time) -> (values, message number)} of derivation inputs
+    inputs = collections.defaultdict(dict)
+
+    for (field, proj, (valid_date, run_date), msg_num, _), vals in zip(to_decode, values):
+        if not field.metric.intermediate:
+            data_by_projection[proj][(field.id, valid_date, run_date)].append(vals)
+        if field.metric_id in input_selectors:
+            inputs[field.metric_id][(valid_date, run_date)] = (vals, msg_num)
 
     with tracing.start_span('generate derived'):
         logger.info("Generating derived fields")
-        for proj, fields in get_source_module(source.short_name).generate_derived(grib).items():
-            for k, v in fields.items():
-                data_by_projection[proj][k].extend(v)
+        for field, (valid_date, run_date), vals, msg_num in run_derivations(derivations, fields_by_metric, inputs):
+            update_field_projection(field, grib.message(msg_num))
+            data_by_projection[field.projection][(field.id, valid_date, run_date)].append(vals)
+
+    grib.close()
+
+    return data_by_projection
 
+
+def save_grib_data(data_by_projection):
+    """
+    Saves decoded GRIB data (as returned by decode_grib_file) to the backend.
+    """
     with tracing.start_span('save denormalized'):
         logger.info("Saving denormalized location/time data for all messages")
         for proj, fields in data_by_projection.items():
             storage.get_provider().put_fields(proj, fields)
 
+    bump_data_version()
+
     logger.info("Done saving denormalized data")
+
+
+def ingest_grib_file(file_path, source):
+    """
+    Ingests a given GRIB file into the backend.
+    :param file_path: Path to the GRIB file
+    :param source: Source object which denotes which source this data is from
+    :return: None
+    """
+    save_grib_data(decode_grib_file(file_path, source))
@@ -2,6 +2,7 @@ import logging
 import numpy
 
 from wx_explore.common import tracing, storage
+from wx_explore.common.cache import bump_data_version
 from wx_explore.common.log_setup import init_sentry
 from wx_explore.common.tracing import init_tracing
 
@@ -12,3 +13,4 @@ if __name__ == "__main__":
     init_tracing('merge')
     with tracing.start_span('merge'):
         storage.get_provider().merge()
+        bump_data_version()
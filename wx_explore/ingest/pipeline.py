@@ -0,0 +1,216 @@
+from datetime import datetime, timedelta
+from typing import Dict
+
+import logging
+import os
+import queue
+import tempfile
+import threading
+
+from wx_explore.common import tracing
+from wx_explore.common.config import Config
+from wx_explore.common.models import Projection, Source
+from wx_explore.common.utils import url_exists
+from wx_explore.ingest.common import get_queue
+from wx_explore.ingest.grib import reduce_grib, decode_grib_file, save_grib_data
+from wx_explore.web.core import app, db
+
+logger = logging.getLogger(__name__)
+
+# Sentinel telling a stage worker to exit
+STOP = None
+
+
+class IngestPipeline(object):
+    """
+    Ingests queue items in three overlapping stages (download, decode, write),
+    each with its own pool of worker threads, connected by bounded queues.
+    The bounds provide backpressure so at most a few decoded files are held in memory.
+
+    Only the thread calling `run` touches the ingest queue itself. Items which fail
+    (or whose URLs don't exist yet) are handed back to it to be rescheduled.
+    Items are taken off the ingest queue as they enter the pipeline, so if `run` is
+    interrupted, everything which hasn't been written yet is put back on it.
+    """
+    def __init__(self, n_download: int, n_decode: int, n_write: int, queue_size: int):
+        self.n_download = n_download
+        self.n_decode = n_decode
+        self.n_write = n_write
+
+        self.download_q: queue.Queue = queue.Queue(queue_size)
+        self.decode_q: queue.Queue = queue.Queue(queue_size)
+        self.write_q: queue.Queue = queue.Queue(queue_size)
+        # (ingest_req, delay) to be put back on the ingest queue
+        self.retry_q: queue.Queue = queue.Queue()
+
+        # Requests in the pipeline which haven't been written (or handed to retry_q) yet, by id()
+        self.in_flight: Dict[int, dict] = {}
+        self._in_flight_lock = threading.Lock()
+
+    def download(self, ingest_req):
+        # If this URL doesn't exist, try again in a few minutes
+        if not (url_exists(ingest_req['url']) and url_exists(ingest_req['idx_url'])):
+            logger.info("Rescheduling request %s", ingest_req)
+            self.retry_q.put((ingest_req, '5m'))
+            return None
+
+        source = Source.query.filter_by(short_name=ingest_req['source']).first()
+
+        # Not deleted on close since it's handed off to the decode stage
+        with tempfile.NamedTemporaryFile(delete=False) as reduced:
+            try:
+                logger.info(f"Downloading and reducing {ingest_req['url']} from {ingest_req['run_time']} {source.short_name}")
+                reduce_grib(ingest_req['url'], ingest_req['idx_url'], source.fields, reduced)
+            except Exception:
+                os.unlink(reduced.name)
+                raise
+
+        return (ingest_req, reduced.name)
+
+    def decode(self, ingest_req, path):
+        try:
+            source = Source.query.filter_by(short_name=ingest_req['source']).first()
+            data_by_projection = decode_grib_file(path, source)
+        finally:
+            os.unlink(path)
+
+        # Projections are keyed by id since ORM objects can't be shared with
+        # the write stage's session (which lives in another thread)
+        return (ingest_req, {proj.id: fields for proj, fields in data_by_projection.items()})
+
+    def write(self, ingest_req, data_by_projection_id):
+        save_grib_data({
+            Projection.query.get(proj_id): fields
+            for proj_id, fields in data_by_projection_id.items()
+        })
+
+        source = Source.query.filter_by(short_name=ingest_req['source']).first()
+        source.last_updated = datetime.utcnow()
+        db.session.commit()
+
+        return None
+
+    def _stage_worker(self, name, fn, in_q, out_q):
+        with app.app_context():
+            while True:
+                item = in_q.get()
+                if item is STOP:
+                    break
+
+                ingest_req = item[0]
+
+                with tracing.start_span(name) as span:
+                    for k, v in ingest_req.items():
+                        span.set_attribute(k, v)
+
+                    try:
+                        result = fn(*item)
+                    except Exception:
+                        logger.exception("Exception while ingesting %s (%s stage). Will retry", ingest_req, name)
+                        db.session.rollback()
+                        self.retry_q.put((ingest_req, '4m'))
+                        self._leave(ingest_req)
+                        continue
+
+                if result is not None and out_q is not None:
+                    out_q.put(result)
+                else:
+                    # Written, or rescheduled through retry_q
+                    self._leave(ingest_req)
+
+    def _enter(self, ingest_req):
+        with self._in_flight_lock:
+            self.in_flight[id(ingest_req)] = ingest_req
+
+    def _leave(self, ingest_req):
+        with self._in_flight_lock:
+            self.in_flight.pop(id(ingest_req), None)
+
+    def _start_stage(self, name, fn, n_workers, in_q, out_q):
+        workers = []
+        for i in range(n_workers):
+            t = threading.Thread(
+                target=self._stage_worker,
+                args=(name, fn, in_q, out_q),
+                name=f"ingest-{name}-{i}",
+                daemon=True,
+            )
+            t.start()
+            workers.append(t)
+        return workers
+
+    @staticmethod
+    def _stop_stage(workers, in_q):
+        for _ in workers:
+            in_q.put(STOP)
+        for t in workers:
+            t.join()
+
+    def _requeue_failed(self, q):
+        while True:
+            try:
+                ingest_req, delay = self.retry_q.get_nowait()
+            except queue.Empty:
+                return
+            q.put(ingest_req, delay)
+
+    def _requeue_in_flight(self, q):
+        """
+        Puts everything still in the pipeline back on the ingest queue.
+        Requests being written right now may end up ingested twice, but none are lost.
+        """
+        with self._in_flight_lock:
+            in_flight = list(self.in_flight.values())
+            self.in_flight.clear()
+
+        if in_flight:
+            logger.warning("Requeueing %d unfinished requests", len(in_flight))
+
+        for ingest_req in in_flight:
+            q.put(ingest_req)
+
+    def run(self, q):
+        downloaders = self._start_stage('download', self.download, self.n_download, self.download_q, self.decode_q)
+        decoders = self._start_stage('decode', self.decode, self.n_decode, self.decode_q, self.write_q)
+        writers = self._start_stage('write', self.write, self.n_write, self.write_q, None)
+
+        try:
+            for ingest_req in q:
+                self._requeue_failed(q)
+
+                # Queue is empty for now
+                if ingest_req is None:
+                    logger.info("Empty queue")
+                    break
+
+                ingest_req = ingest_req.data
+
+                # Expire out anything whose valid time is very old (probably a bad request/URL)
+                if datetime.utcfromtimestamp(ingest_req['valid_time']) < datetime.utcnow() - timedelta(hours=12):
+                    logger.info("Expiring old request %s", ingest_req)
+                    continue
+
+                self._enter(ingest_req)
+                # Blocks if the pipeline is full
+                self.download_q.put((ingest_req,))
+
+            # Drain the pipeline in order so each stage sees everything from the previous one
+            self._stop_stage(downloaders, self.download_q)
+            self._stop_stage(decoders, self.decode_q)
+            self._stop_stage(writers, self.write_q)
+        finally:
+            # Only non-empty if we were interrupted (the stage workers are daemons, so die with us)
+            self._requeue_failed(q)
+            self._requeue_in_flight(q)
+
+
+def ingest_from_queue():
+    with app.app_context():
+        pipeline = IngestPipeline(
+            Config.INGEST_DOWNLOAD_WORKERS,
+            Config.INGEST_DECODE_WORKERS,
+            Config.INGEST_WRITE_WORKERS,
+            Config.INGEST_STAGE_QUEUE_SIZE,
+        )
+        pipeline.run(get_queue())
+
@@ -0,0 +1,146 @@
+from typing import Dict, Optional
+
+import hashlib
+import logging
+import os
+import threading
+
+from wx_explore.common.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class GribRangeCache(object):
+    """
+    On-disk cache of GRIB byte ranges, so retries and backfills of the same file
+    don't have to download everything again.
+
+    Entries are content-addressed by (url, start, length). GRIBs are never modified once
+    published, so entries never go stale; the least recently used entries are evicted
+    once the cache grows past max_bytes.
+    """
+    path: str
+    max_bytes: int
+
+    hits: int
+    misses: int
+    bytes_hit: int
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+
+        # Size of everything in the cache. Lazily computed since other processes may share the directory
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _entry_path(self, url: str, start: int, length: int) -> str:
+        key = hashlib.sha256(f"{url}:{start}:{length}".encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, url: str, start: int, length: int) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+
+        path = self._entry_path(url, start, length)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Bump mtime so eviction is LRU rather than FIFO
+            os.utime(path)
+        except FileNotFoundError:
+            data = None
+
+        with self._lock:
+            if data is not None and len(data) == length:
+                self.hits += 1
+                self.bytes_hit += length
+                return data
+
+            self.misses += 1
+            return None
+
+    def put(self, url: str, start: int, length: int, data: bytes):
+        if not self.enabled or len(data) != length or length > self.max_bytes:
+            return
+
+        path = self._entry_path(url, start, length)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file and rename so concurrent readers never see a partial entry
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Unable to write GRIB range to cache")
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += length
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield (st.st_mtime, st.st_size, path)
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache is at 90% of max_bytes.
+        Must be called with the lock held.
+        """
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+
+        n_evicted = 0
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            n_evicted += 1
+
+        logger.info("Evicted %d entries from GRIB range cache", n_evicted)
+
+        self._size = size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_hit': self.bytes_hit,
+            }
+
+
+range_cache = GribRangeCache(Config.GRIB_CACHE_DIR, Config.GRIB_CACHE_MAX_BYTES)
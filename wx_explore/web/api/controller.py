@@ -1,6 +1,5 @@
 from datetime import datetime, timedelta
-from flask import Blueprint, abort, jsonify, request
-from sqlalchemy import or_
+from flask import Blueprint, abort, json, jsonify, request
 
 import collections
 import pytz
@@ -14,14 +13,16 @@ from wx_explore.common import (
     metrics,
     tracing,
 )
+from wx_explore.common.cache import bucketed_now, response_cache
+from wx_explore.common.catalog import catalog
 from wx_explore.common.models import (
     Source,
-    SourceField,
     Location,
     Metric,
     Timezone,
+    DataPointBatch,
 )
-from wx_explore.common.storage import load_data_points
+from wx_explore.common.storage import get_grid_cells, load_data_points, load_data_points_batch
 from wx_explore.common.utils import datetime2unix
 from wx_explore.web.app import app
 
@@ -138,28 +139,16 @@ def get_tz_for_coords():
     })
 
 
-@api.route('/wx')
-def wx_for_location():
-    """
-    Gets the weather for a specific location, optionally limiting by metric and time.
-    at that time.
-    """
-    lat = float(request.args['lat'])
-    lon = float(request.args['lon'])
-
-    if lat > 90 or lat < -90 or lon > 180 or lon < -180:
-        abort(400)
+# Maximum number of locations that can be requested in a single batch
+MAX_BATCH_LOCATIONS = 500
 
-    requested_metrics = request.args.getlist('metrics', int)
 
-    if requested_metrics:
-        metric_ids = set(requested_metrics)
-    else:
-        metric_ids = Metric.query.with_entities(Metric.id)
-
-    now = datetime.now(pytz.UTC)
-    start = request.args.get('start', type=int)
-    end = request.args.get('end', type=int)
+def get_wx_time_range(start, end):
+    """
+    Determines the time range to load data for given the (optional) unix start and end
+    times from a request, clamping them to reasonable values.
+    """
+    now = bucketed_now()
 
     if start is None:
         start = now - timedelta(hours=1)
@@ -179,34 +168,136 @@ def wx_for_location():
             if end > now + timedelta(days=7):
                 end = now + timedelta(days=7)
 
-    requested_source_fields = SourceField.query.filter(
-        SourceField.metric_id.in_(metric_ids),
-        SourceField.projection_id != None,  # noqa: E711
-    ).all()
+    return start, end
 
-    with tracing.start_span("load_data_points") as span:
-        span.set_attribute("start", str(start))
-        span.set_attribute("end", str(end))
-        span.set_attribute("source_fields", str(requested_source_fields))
-        data_points = load_data_points((lat, lon), start, end, requested_source_fields)
+
+def get_wx_source_fields(requested_metrics):
+    if requested_metrics:
+        return catalog.get_source_fields(requested_metrics)
+
+    return catalog.get_source_fields()
+
+
+def serialize_wx(data_points):
+    batch = DataPointBatch.from_data_points(data_points)
 
     # valid time -> data points
     datas = collections.defaultdict(list)
 
-    for dp in data_points:
+    for dp, median in zip(batch, batch.medians().tolist()):
         datas[datetime2unix(dp.valid_time)].append({
             'run_time': datetime2unix(dp.run_time),
             'src_field_id': dp.source_field_id,
-            'value': dp.median(),
-            'raw_values': dp.values,
+            'value': median,
+            'raw_values': dp.values.tolist(),
         })
 
-    wx = {
+    return {
         'data': datas,
         'ordered_times': sorted(datas.keys()),
     }
 
-    return jsonify(wx)
+
+def cached_json_response(key, build):
+    """
+    Returns the JSON response for the given cache key, only calling build to create it on a cache miss.
+    Sets an ETag on the response so clients can skip downloading a response they already have.
+    """
+    etag = response_cache.etag(key)
+
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        body = response_cache.get(etag)
+        if body is None:
+            body = json.dumps(build()).encode('utf-8')
+            response_cache.set(etag, body)
+
+        resp = app.response_class(body, mimetype='application/json')
+
+    resp.set_etag(etag)
+    return resp
+
+
+@api.route('/wx')
+def wx_for_location():
+    """
+    Gets the weather for a specific location, optionally limiting by metric and time.
+    at that time.
+    """
+    lat = float(request.args['lat'])
+    lon = float(request.args['lon'])
+
+    if lat > 90 or lat < -90 or lon > 180 or lon < -180:
+        abort(400)
+
+    start, end = get_wx_time_range(request.args.get('start', type=int), request.args.get('end', type=int))
+    requested_source_fields = get_wx_source_fields(request.args.getlist('metrics', int))
+
+    def build():
+        with tracing.start_span("load_data_points") as span:
+            span.set_attribute("start", str(start))
+            span.set_attribute("end", str(end))
+            span.set_attribute("source_fields", str(requested_source_fields))
+            data_points = load_data_points((lat, lon), start, end, requested_source_fields)
+
+        return serialize_wx(data_points)
+
+    # Everything in the same grid cell(s) gets the same data
+    cache_key = (
+        'wx',
+        tuple(get_grid_cells((lat, lon), requested_source_fields)),
+        tuple(sorted(sf.id for sf in requested_source_fields)),
+        datetime2unix(start),
+        datetime2unix(end),
+    )
+
+    return cached_json_response(cache_key, build)
+
+
+@api.route('/wx/batch', methods=['POST'])
+def wx_for_locations():
+    """
+    Gets the weather for many locations at once, optionally limiting by metric and time.
+    Expects a JSON body of the form
+    {"locations": [{"lat": ..., "lon": ...}, ...], "metrics": [...], "start": ..., "end": ...}
+    where all but "locations" are optional.
+    Returns a list with the same result /wx would give for each location, in the same order.
+    """
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict) or not isinstance(body.get('locations'), list):
+        abort(400)
+
+    if len(body['locations']) > MAX_BATCH_LOCATIONS:
+        abort(400)
+
+    # Metric ids must be JSON integers (int() would accept e.g. "12" as [1, 2] or 1.5 as 1)
+    requested_metrics = body.get('metrics', [])
+    if not isinstance(requested_metrics, list) or not all(type(m) is int for m in requested_metrics):
+        abort(400)
+
+    try:
+        coords = [(float(loc['lat']), float(loc['lon'])) for loc in body['locations']]
+        start = int(body['start']) if body.get('start') is not None else None
+        end = int(body['end']) if body.get('end') is not None else None
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    if any(lat > 90 or lat < -90 or lon > 180 or lon < -180 for lat, lon in coords):
+        abort(400)
+
+    start, end = get_wx_time_range(start, end)
+    requested_source_fields = get_wx_source_fields(requested_metrics)
+
+    with tracing.start_span("load_data_points_batch") as span:
+        span.set_attribute("start", str(start))
+        span.set_attribute("end", str(end))
+        span.set_attribute("num_locations", len(coords))
+        span.set_attribute("source_fields", str(requested_source_fields))
+        data_points = load_data_points_batch(coords, start, end, requested_source_fields)
+
+    return jsonify([serialize_wx(loc_data_points) for loc_data_points in data_points])
 
 
 @api.route('/wx/summarize')
@@ -227,7 +318,7 @@ def summarize():
         abort(400)
 
     # TODO: This should be done relative to the location's local TZ
-    now = datetime.now(pytz.UTC)
+    now = bucketed_now()
     if start is None:
         start = now
     else:
@@ -237,38 +328,48 @@ def summarize():
             if start < now - timedelta(days=1):
                 start = now - timedelta(days=1)
 
-    source_fields = SourceField.query.filter(
-        or_(
-            SourceField.metric == metrics.temp,
-            SourceField.metric == metrics.raining,
-            SourceField.metric == metrics.snowing,
-            SourceField.metric_id.in_([metrics.wind_speed.id, metrics.wind_direction.id, metrics.gust_speed.id]),
-            SourceField.metric == metrics.cloud_cover,
-            SourceField.metric == metrics.composite_reflectivity,
-        ),
-        SourceField.projection_id != None,
-    ).all()
-
-    with tracing.start_span("load_data_points") as span:
-        end = start + timedelta(days=days)
-        span.set_attribute("start", str(start))
-        span.set_attribute("end", str(end))
-        span.set_attribute("source_fields", str(source_fields))
-        data_points = load_data_points((lat, lon), start, end, source_fields)
-
-    with tracing.start_span("combine_models") as span:
-        combined_data_points = combine_models(data_points)
-
-    time_ranges = [(start, start.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))]
-    for d in range(1, days):
-        last_end = time_ranges[-1][1]
-        time_ranges.append((last_end, last_end + timedelta(days=1)))
-
-    summarizations = []
-
-    with tracing.start_span("summarizations") as span:
-        for dstart, dend in time_ranges:
-            summary = SummarizedData(dstart, dend, combined_data_points)
-            summarizations.append(summary.dict())
-
-    return jsonify(summarizations)
+    source_fields = catalog.get_source_fields([
+        metrics.temp.id,
+        metrics.raining.id,
+        metrics.snowing.id,
+        metrics.wind_speed.id,
+        metrics.wind_direction.id,
+        metrics.gust_speed.id,
+        metrics.cloud_cover.id,
+        metrics.composite_reflectivity.id,
+    ])
+
+    end = start + timedelta(days=days)
+
+    def build():
+        with tracing.start_span("load_data_points") as span:
+            span.set_attribute("start", str(start))
+            span.set_attribute("end", str(end))
+            span.set_attribute("source_fields", str(source_fields))
+            data_points = load_data_points((lat, lon), start, end, source_fields)
+
+        with tracing.start_span("combine_models") as span:
+            combined_data_points = combine_models(data_points)
+
+        time_ranges = [(start, start.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))]
+        for d in range(1, days):
+            last_end = time_ranges[-1][1]
+            time_ranges.append((last_end, last_end + timedelta(days=1)))
+
+        summarizations = []
+
+        with tracing.start_span("summarizations") as span:
+            for dstart, dend in time_ranges:
+                summary = SummarizedData(dstart, dend, combined_data_points)
+                summarizations.append(summary.dict())
+
+        return summarizations
+
+    cache_key = (
+        'summarize',
+        tuple(get_grid_cells((lat, lon), source_fields)),
+        datetime2unix(start),
+        days,
+    )
+
+    return cached_json_response(cache_key, build)
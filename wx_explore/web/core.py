@@ -9,7 +9,9 @@ app.config.from_object(Config)
 CORS(app)
 
 from wx_explore.common.models import Base
+from wx_explore.common.schema import upgrade_schema
 db = SQLAlchemy(app, model_class=Base)
 
 with app.app_context():
-    db.create_all()
\ No newline at end of file
+    db.create_all()
+    upgrade_schema(db.engine)
\ No newline at end of file